@@ -0,0 +1,361 @@
+#!/usr/bin/env python3
+"""Run many headless games in parallel, for balance testing.
+
+Every run plays one game with its own seed, driven by an input policy
+instead of the keyboard, as fast as the machine allows.  The runs are
+spread over a pool of processes, and their stats are collected into one
+report: score, frames survived, simulation speed and the peak number of
+entities of each kind.
+
+Options the runner does not know are passed on to the game, such as
+"-e numpy" for jatype.
+"""
+import argparse
+import csv
+import importlib
+import json
+import multiprocessing
+import os
+import random
+import statistics
+import sys
+import time
+
+os.environ.setdefault('PYGAME_HIDE_SUPPORT_PROMPT', '1')
+import pygame
+
+
+DEFAULT_RUNS = 8
+DEFAULT_FRAMES = 3600  # Most frames per run
+POLICY_NAMES = ('autopilot', 'random')
+
+
+class Policy(object):
+    """Input for one run, in place of an input recording.
+    Games take their input from anything with events() and finished,
+    like an InputReplayer.  Policies draw their random numbers from their
+    own generator, so the game sees the same random numbers as when it is
+    played from the keyboard.
+    """
+    def __init__(self, seed):
+        """Initialize the policy.
+        Args:
+            seed: Seed of the run.
+        """
+        self.random = random.Random(seed)
+        self.game = None
+        self.finished = False
+        self._held = {}
+
+    def events(self):
+        """Get the input events for the next step.
+        Returns:
+            List of events.
+        """
+        return self.decide(self.game)
+
+    def decide(self, game):
+        """Choose the input for the next step.
+        Args:
+            game: Game being played.
+        Returns:
+            List of events.
+        """
+        raise NotImplementedError
+
+    def hold(self, axis, key):
+        """Hold one key of a group of keys, such as up and down.
+        Args:
+            axis: Name of the key group.
+            key: Key to hold down; None to hold none.
+        Returns:
+            List of events to release the key held so far and press the
+            new one, if they differ.
+        """
+        events = []
+        held = self._held.get(axis)
+        if held != key:
+            if held is not None:
+                events.append(pygame.event.Event(pygame.KEYUP, key=held))
+            if key is not None:
+                events.append(pygame.event.Event(pygame.KEYDOWN, key=key))
+            self._held[axis] = key
+        return events
+
+    @staticmethod
+    def press(key):
+        """Press and release a key within the step.
+        Args:
+            key: Key to press.
+        Returns:
+            List of events.
+        """
+        return [pygame.event.Event(pygame.KEYDOWN, key=key),
+                pygame.event.Event(pygame.KEYUP, key=key)]
+
+
+class JatypeAutopilot(Policy):
+    """Lines up with the nearest enemy ahead and keeps firing.
+    """
+    def decide(self, game):
+        player = game.player
+        board_width = pygame.display.get_surface().get_width()
+        ahead = [enemy for enemy in game.enemies
+                 if player.x_pos < enemy.x_pos < board_width]
+        if ahead:
+            enemy = min(ahead, key=lambda enemy: enemy.x_pos)
+            target = enemy.y_pos + enemy.height // 2
+        else:
+            target = player.y_pos + player.height // 2
+        middle = player.y_pos + player.height // 2
+        if middle < target - player.speed:
+            vertical = pygame.K_DOWN
+        elif middle > target + player.speed:
+            vertical = pygame.K_UP
+        else:
+            vertical = None
+        # Keep to the left, for time to react
+        if player.x_pos > board_width // 4:
+            horizontal = pygame.K_LEFT
+        else:
+            horizontal = None
+        events = (self.hold('vertical', vertical)
+                  + self.hold('horizontal', horizontal))
+        if not game.frames % 4:
+            events.extend(self.press(pygame.K_SPACE))
+        return events
+
+
+class JatypeRandom(Policy):
+    """Moves about at random, firing often.
+    """
+    def decide(self, game):
+        events = []
+        if self.random.random() < 0.05:
+            events.extend(self.hold('vertical', self.random.choice(
+                (pygame.K_UP, pygame.K_DOWN, None))))
+        if self.random.random() < 0.05:
+            events.extend(self.hold('horizontal', self.random.choice(
+                (pygame.K_LEFT, pygame.K_RIGHT, None))))
+        if self.random.random() < 0.2:
+            events.extend(self.press(pygame.K_SPACE))
+        if self.random.random() < 0.005:
+            events.extend(self.press(pygame.K_c))
+        return events
+
+
+class BlockboostAutopilot(Policy):
+    """Flies along the middle of the tube.
+    """
+    def decide(self, game):
+        player = game.player
+        tube = game.tube
+        top = tube.get_y_at_x(player.x_pos + player.width)
+        if top is None:
+            middle = tube.board_height // 2
+        else:
+            middle = top + tube.diameter * tube.block_height // 2
+        rising = player.y_pos + player.height // 2 > middle
+        return self.hold('thrust', pygame.K_SPACE if rising else None)
+
+
+class BlockboostRandom(Policy):
+    """Thrusts on and off at random.
+    """
+    def decide(self, game):
+        if self.random.random() < 0.1:
+            return self.hold('thrust', self.random.choice(
+                (pygame.K_SPACE, None)))
+        return []
+
+
+class Jatype(object):
+    """How to run jatype.
+    """
+    ARGS = ['--headless']
+    COUNTS = ('enemies', 'bullets', 'bonuses', 'enemy_bullets')
+    POLICIES = {'autopilot': JatypeAutopilot, 'random': JatypeRandom}
+
+    @staticmethod
+    def new_game(module):
+        return module.Game()
+
+    @staticmethod
+    def score(game):
+        return game.player.score
+
+    @staticmethod
+    def counts(game):
+        return (len(game.enemies), len(game.player.bullets),
+                len(game.bonuses), len(game.enemy_bullets))
+
+
+class Blockboost(object):
+    """How to run blockboost, with enemies and tube.
+    The score is how far the player got toward the goal.
+    """
+    ARGS = ['--enemies', '--tube']
+    COUNTS = ('enemies', 'blocks')
+    POLICIES = {'autopilot': BlockboostAutopilot, 'random': BlockboostRandom}
+
+    @staticmethod
+    def new_game(module):
+        return module.Game(module.BOARD)
+
+    @staticmethod
+    def score(game):
+        return game.player.x_pos
+
+    @staticmethod
+    def counts(game):
+        tube = game.tube
+        return (len(game.enemies),
+                len(tube.blocks_top) + len(tube.blocks_bottom))
+
+
+GAMES = {'jatype': Jatype, 'blockboost': Blockboost}
+_WORKER = {}  # Game module and description, per worker process
+
+
+def parse_args():
+    """Parse user arguments and return as parser object.
+    Returns:
+        Tuple: (parser object with arguments as attributes, list of
+            arguments for the game)
+    """
+    parser = argparse.ArgumentParser(
+            description='Run headless games in parallel and report stats. '
+            'Unknown options are passed on to the game.')
+    parser.add_argument('game', choices=sorted(GAMES),
+            help='Game to run.')
+    parser.add_argument('-n', '--runs', type=int, default=DEFAULT_RUNS,
+            help='Number of runs (default: %d).' % DEFAULT_RUNS)
+    parser.add_argument('-s', '--seed', type=int, default=0,
+            help='Seed of the first run; the others count up from it '
+            '(default: 0).')
+    parser.add_argument('-f', '--frames', type=int, default=DEFAULT_FRAMES,
+            help='Most frames per run (default: %d).' % DEFAULT_FRAMES)
+    parser.add_argument('-j', '--jobs', type=int,
+            help='Number of processes (default: one per CPU).')
+    parser.add_argument('-p', '--policy', choices=POLICY_NAMES,
+            default=POLICY_NAMES[0],
+            help='Input policy (default: %s).' % POLICY_NAMES[0])
+    parser.add_argument('-o', '--output', metavar='FILE',
+            help='Also write the stats of every run to FILE (CSV if FILE '
+            'ends in .csv, JSON otherwise).')
+    args, game_args = parser.parse_known_args()
+    if args.runs < 1 or args.frames < 1:
+        parser.error('runs and frames must be at least 1')
+    return args, game_args
+
+
+def init_worker(game_name, game_args):
+    """Set a worker process up to run games.
+    Args:
+        game_name: Name of the game module.
+        game_args: Arguments for the game.
+    """
+    os.environ['SDL_VIDEODRIVER'] = 'dummy'
+    module = importlib.import_module(game_name)
+    module.setup(module.parse_args(game_args))
+    _WORKER['module'] = module
+    _WORKER['game'] = GAMES[game_name]
+
+
+def run_game(seed, policy_name, frames):
+    """Play one game in a worker process.
+    Args:
+        seed: Random seed of the game.
+        policy_name: Name of the input policy.
+        frames: Most frames to run.
+    Returns:
+        Dictionary of stats.
+    """
+    module = _WORKER['module']
+    description = _WORKER['game']
+    random.seed(seed)
+    policy = description.POLICIES[policy_name](seed)
+    module.REPLAYER = policy
+    game = policy.game = description.new_game(module)
+    peaks = [0] * len(description.COUNTS)
+    count = 0
+    start_time = time.perf_counter()
+    while not game.game_over and count < frames:
+        game.step()
+        count += 1
+        peaks = [max(peak, now) for peak, now
+                 in zip(peaks, description.counts(game))]
+    elapsed = time.perf_counter() - start_time
+    stats = {'seed': seed, 'score': description.score(game),
+             'frames': count, 'fps': count / elapsed if elapsed else 0.0}
+    for name, peak in zip(description.COUNTS, peaks):
+        stats['peak_%s' % name] = peak
+    return stats
+
+
+def _run_game(task):
+    return run_game(*task)
+
+
+def write_report(path, runs):
+    """Write the stats of every run to a file.
+    Args:
+        path: Output file; CSV if it ends in .csv, otherwise JSON.
+        runs: List of stats dictionaries.
+    """
+    with open(path, 'w', newline='') as out_file:
+        if path.lower().endswith('.csv'):
+            writer = csv.DictWriter(out_file, fieldnames=list(runs[0]))
+            writer.writeheader()
+            writer.writerows(runs)
+        else:
+            json.dump(runs, out_file, indent=2)
+
+
+def show_summary(runs, elapsed):
+    """Print the spread of every stat over all runs.
+    Args:
+        runs: List of stats dictionaries.
+        elapsed: Wall-clock time of all runs, in seconds.
+    """
+    frames = sum(stats['frames'] for stats in runs)
+    print('%d runs, %d frames in %.1f s (%.1f FPS overall)'
+          % (len(runs), frames, elapsed, frames / elapsed if elapsed else 0))
+    print('%-16s %10s %10s %10s' % ('', 'mean', 'min', 'max'))
+    for name in runs[0]:
+        if name == 'seed':
+            continue
+        values = [stats[name] for stats in runs]
+        print('%-16s %10.1f %10.1f %10.1f'
+              % (name, statistics.mean(values), min(values), max(values)))
+
+
+def main():
+    """Run the batch.
+    """
+    args, game_args = parse_args()
+    game_args = GAMES[args.game].ARGS + game_args
+    if args.game == 'jatype':
+        game_args += ['--frames', str(args.frames)]
+    # Check the game arguments here, not once per worker
+    importlib.import_module(args.game).parse_args(game_args)
+
+    tasks = [(seed, args.policy, args.frames)
+             for seed in range(args.seed, args.seed + args.runs)]
+    start_time = time.perf_counter()
+    pool = multiprocessing.Pool(args.jobs, init_worker,
+                                (args.game, game_args))
+    runs = pool.map(_run_game, tasks)
+    # SDL catches SIGTERM, so let the workers exit rather than terminate
+    pool.close()
+    pool.join()
+    elapsed = time.perf_counter() - start_time
+
+    show_summary(runs, elapsed)
+    if args.output:
+        write_report(args.output, runs)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -8,11 +8,19 @@ import logging
 import os
 import random
 import sys
+import time
 
 import pygame
 
+from capture import CAPTURE_FRAMES, FrameCapture
+from entities import Entity, EntityList
+from imagestore import ImageStore, default_cache_path
+from replay import InputRecorder, InputReplayer
+
 
 FRAME_RATE = 30
+STEP_TIME = 1.0 / FRAME_RATE  # Simulated time per step, in seconds
+MAX_STEPS = 5  # Steps per drawn frame before the game slows down
 BOARD_WIDTH, BOARD_HEIGHT = BOARD_SIZE = 640, 480
 DEFAULT_SPEED = 10
 DEFAULT_ENEMIES = 10
@@ -24,60 +32,14 @@ SECTION_MIN = 4
 DIAMETER_MIN = 6
 DIAMETER_MAX = 14
 
+ENGINES = ('sprite', 'slots')
+
 LOG_LEVELS = ('CRITICAL', 'ERROR', 'WARNING', 'INFO', 'DEBUG')
 DEFAULT_LOG_LEVEL = LOG_LEVELS[3]
+SEED_MAX = 2 ** 62
 LOGGER = logging.getLogger()
 
 
-class ImageStore(object):
-    """Image store.
-    """
-    def __init__(self, path, ext='png'):
-        """Initialize the store.
-        Args:
-            path: Path to image files.
-            ext: File extension image files.
-        """
-        self._store = {}
-        self._path = path
-        self._ext = ext
-
-    def get(self, name):
-        """Get image object.
-        If the image does not exist in the store, this will also try to
-        add it first, but it is better to pre-add images as there is
-        less delay.
-        Args:
-            name: Name of image to get.
-        Returns:
-            Image object, or None if object could not be found.
-        """
-        if name in self._store:
-            image = self._store[name]
-        else:
-            image = self.add(name)
-        LOGGER.debug(self._store)
-        return image
-
-    def add(self, name):
-        """Add image object to the store.
-        Args:
-            name: Name of image to add.
-        Returns:
-            Image object, or None if object could not be loaded.
-        """
-        image_path = os.path.join(self._path, '%s.%s' % (name, self._ext))
-        try:
-            image_object = pygame.image.load(image_path).convert_alpha()
-        except pygame.error:
-            LOGGER.error('Could not load image %s', image_path)
-            #font = pygame.font.Font(None, 48)
-            #image_object = font.render('X', True, (255, 0, 0))
-            image_object = None
-        self._store[name] = image_object
-        return image_object
-
-
 class Character(pygame.sprite.Sprite):
     """All controllable things.
     """
@@ -98,8 +60,8 @@ class Character(pygame.sprite.Sprite):
         # Update position by setting the values of rect.x and rect.y
         self.rect = self.image.get_rect()
 
-        self.rect.x = self.x_pos = x_pos
-        self.rect.y = self.y_pos = y_pos
+        self.rect.x = self.x_prev = self.x_pos = x_pos
+        self.rect.y = self.y_prev = self.y_pos = y_pos
 
         self.speed_x = 0
         self.speed_y = 0
@@ -113,9 +75,25 @@ class Character(pygame.sprite.Sprite):
             y_pos = self.y_pos
         self.board.blit(self.image, (x_pos, y_pos))
 
+    def position(self, alpha=None):
+        """Get where to draw the character.
+        Args:
+            alpha: Fraction of a step to move on from the previous
+                position towards the current one; None for the current
+                position.
+        Returns:
+            Tuple: (x_pos, y_pos)
+        """
+        if alpha is None:
+            return self.x_pos, self.y_pos
+        return (self.x_prev + (self.x_pos - self.x_prev) * alpha,
+                self.y_prev + (self.y_pos - self.y_prev) * alpha)
+
     def update(self):
         """Update sprite.
         """
+        self.x_prev = self.x_pos
+        self.y_prev = self.y_pos
         self.x_pos += self.speed_x
         self.y_pos += self.speed_y
         self.rect.x = self.x_pos
@@ -160,7 +138,7 @@ class Player(Character):
             String: 'quit', 'pause', or '' (empty string)
         """
         return_value = ''
-        for event in pygame.event.get():
+        for event in get_events():
             if event.type == pygame.QUIT:
                 ## Did the user click the 'close' icon on the game window?
                 return_value = 'quit'
@@ -205,10 +183,18 @@ class Player(Character):
         elif self.y_pos + self.speed_y < 0:
             self.y_pos = self.speed
         super(Player, self).update()
+
+    def draw(self, alpha=None):
+        """Draw player, and its mirror image if mirrored.
+        Args:
+            alpha: See Character.position().
+        """
+        x_pos, y_pos = self.position(alpha)
+        self.display(x_pos, y_pos)
         if self.mirror:
             half_board = self.board.get_height() / 2
-            mirror_y = half_board - (self.y_pos - half_board) - self.height
-            self.display(y_pos=mirror_y)
+            mirror_y = half_board - (y_pos - half_board) - self.height
+            self.display(x_pos, mirror_y)
 
 
 class Block(Character):
@@ -227,20 +213,56 @@ class Block(Character):
         self.speed_x = speed
 
 
+class BlockEntity(Entity):
+    """Block without a per-instance dictionary, for the slots engine.
+    It behaves the same as Block, whose Character methods it shares, but
+    is much smaller, and lives in an EntityList instead of a sprite group.
+    """
+    __slots__ = ('kind', 'board', 'speed', 'speed_x', 'speed_y')
+
+    display = Character.display
+    position = Character.position
+    update = Character.update
+
+    def __init__(self, kind, board, x_pos=0, y_pos=0, speed=0):
+        """Put a block on a grid.
+        Args:
+            kind: image type to use.
+            board: PyGame display surface.
+            x_pos: X location.
+            y_pos: Y location.
+        """
+        super(BlockEntity, self).__init__()
+        self.kind = 'block/%s' % kind
+        self.board = board
+        self.speed = DEFAULT_SPEED
+        self.image = IMAGES.get(self.kind)
+        self.width, self.height = self.image.get_size()
+        self.rect = self.image.get_rect()
+        self.rect.x = self.x_prev = self.x_pos = x_pos
+        self.rect.y = self.y_prev = self.y_pos = y_pos
+        self.speed_x = speed
+        self.speed_y = 0
+
+
 class BlockTube(object):
     """The tube that serves as the game track.
     """
     def __init__(self, kind, board, speed=0):
         """Set up how the tube 'moves'.
         """
-        self.blocks_top = pygame.sprite.Group()
-        self.blocks_bottom = pygame.sprite.Group()
+        if ARGS.engine == 'slots':
+            self._block_class, group_class = BlockEntity, EntityList
+        else:
+            self._block_class, group_class = Block, pygame.sprite.Group
+        self.blocks_top = group_class()
+        self.blocks_bottom = group_class()
 
         self.board = board
         self.board_width, self.board_height = self.board.get_size()
 
         self.kind = kind
-        block = Block(self.kind, self.board, self.board_width)
+        block = self._block_class(self.kind, self.board, self.board_width)
         self.block_width = block.width
         self.block_height = block.height
 
@@ -270,8 +292,12 @@ class BlockTube(object):
             Y-position, as display coordinate.
         """
         tube_y = None
+        tube_x = None
         for block in self.blocks_top:
-            if x_pos >= block.x_pos and x_pos <= block.x_pos + block.width:
+            # Where two blocks meet, the one on the right counts
+            if (x_pos >= block.x_pos and x_pos <= block.x_pos + block.width
+                    and (tube_x is None or block.x_pos > tube_x)):
+                tube_x = block.x_pos
                 tube_y = block.y_pos + block.height
         return tube_y
 
@@ -293,11 +319,13 @@ class BlockTube(object):
             kind: Image type to use for the section.
         """
         x_pos, y_pos = self.grid_to_display(self.grid_width, self.grid_y)
-        new_block = Block(self.kind, self.board, x_pos, y_pos, self._speed)
+        new_block = self._block_class(self.kind, self.board, x_pos, y_pos,
+                                      self._speed)
         self.blocks_top.add(new_block)
         grid_y_side = int(self.grid_y + self.diameter + 1)
         x_end, y_end = self.grid_to_display(self.grid_width, grid_y_side)
-        new_block = Block(self.kind, self.board, x_end, y_end, self._speed)
+        new_block = self._block_class(self.kind, self.board, x_end, y_end,
+                                      self._speed)
         self.blocks_bottom.add(new_block)
 
     def update(self):
@@ -343,6 +371,8 @@ class Background(object):
     """
     def __init__(self, layers, board, speed_x=0, speed_y=0):
         """Initialize scrolling background object.
+        Each layer is pre-tiled once into a surface big enough to hold
+        any wrapped-around view of it, so drawing a layer is one blit.
         Args:
             layers: A list of background names.
         """
@@ -350,6 +380,7 @@ class Background(object):
         if not isinstance(layers, (list, tuple)):
             layers = [layers]
         self.layers = pygame.sprite.Group()
+        self.tiles = {}
         for incr, layer_name in enumerate(layers):
             image = 'background/%s' % layer_name
             layer = Character(image, self.board, 0, 0)
@@ -357,45 +388,57 @@ class Background(object):
             layer.speed_y = speed_y + int(speed_y * (incr + 1) / len(layers))
             LOGGER.debug('x: %d, y: %d', layer.speed_x, layer.speed_y)
             self.layers.add(layer)
+            self.tiles[layer] = self.build_tile(layer)
+        self.area = self.board.get_rect()
+
+    def build_tile(self, layer):
+        """Composite copies of a layer into one wrap-around surface.
+        Args:
+            layer: Background layer character.
+        Returns:
+            Surface with the layer repeated to cover the board, plus one
+            more copy in each direction the layer scrolls.
+        """
+        board_width, board_height = self.board.get_size()
+        columns = -(-board_width // layer.width) + bool(layer.speed_x)
+        rows = -(-board_height // layer.height) + bool(layer.speed_y)
+        tile = pygame.Surface((layer.width * columns, layer.height * rows),
+                              pygame.SRCALPHA)
+        for column in range(columns):
+            for row in range(rows):
+                tile.blit(layer.image,
+                          (column * layer.width, row * layer.height))
+        # Layers without transparency blit faster without an alpha channel
+        opaque = pygame.mask.from_surface(layer.image, 254).count()
+        if opaque == layer.width * layer.height:
+            tile = tile.convert()
+        else:
+            tile = tile.convert_alpha()
+        return tile
 
     def update(self):
-        """Update backgrounds.
+        """Scroll backgrounds.
         """
+        self.layers.update()
         for layer in self.layers:
             if layer.x_pos <= -layer.width or layer.x_pos >= layer.width:
                 layer.x_pos = 0
             if layer.y_pos <= -layer.height or layer.y_pos >= layer.height:
                 layer.y_pos = 0
 
-            if layer.speed_x:
-                self.board.blit(layer.image,
-                        (layer.x_pos - cmp(layer.speed_x, 0) * layer.width,
-                         layer.y_pos))
-            if layer.speed_y:
-                self.board.blit(layer.image,
-                        (layer.x_pos,
-                         layer.y_pos - cmp(layer.speed_y, 0) * layer.height))
-                # If movement is diagonal, a fourth copy is required
-                if layer.speed_x:
-                    self.board.blit(layer.image,
-                            (layer.x_pos - cmp(layer.speed_x, 0) * layer.width,
-                            layer.y_pos - cmp(layer.speed_y, 0) * layer.height))
-        self.layers.update()
-        self.layers.draw(self.board)
-
-
-def cmp(x, y):
-    if x < y:
-        result = -1
-    elif x > y:
-        result = 1
-    else:
-        result = 0
-    return result
+    def draw(self):
+        """Draw backgrounds.
+        """
+        for layer in self.layers:
+            self.area.x = -layer.x_pos % layer.width
+            self.area.y = -layer.y_pos % layer.height
+            self.board.blit(self.tiles[layer], (0, 0), self.area)
 
 
-def parse_args():
+def parse_args(argv=None):
     """Parse user arguments and return as parser object.
+    Args:
+        argv: Arguments to parse; None for the command line.
     Returns:
         Parser object with arguments as attributes.
     """
@@ -407,49 +450,103 @@ def parse_args():
             help='Enable tube.')
     parser.add_argument('-i', '--infinite', action='store_true',
             help='Enable infinite mode (no dying).')
+    parser.add_argument('-s', '--seed', type=int,
+            help='Seed the random number generator.')
+    recording = parser.add_mutually_exclusive_group()
+    recording.add_argument('-r', '--record', metavar='FILE',
+            help='Record the random seed and all input to FILE.')
+    recording.add_argument('-R', '--replay', metavar='FILE',
+            help='Replay the input recorded in FILE; use the same options '
+            'as when recording.')
+    parser.add_argument('--fixed-step', action='store_true',
+            help='Simulate at a fixed rate however fast frames are drawn, '
+            'drawing sprites between steps.')
+    parser.add_argument('--max-steps', type=int, default=MAX_STEPS,
+            metavar='STEPS',
+            help='With --fixed-step, most steps to simulate per drawn frame '
+            'before slowing down; 1 never skips frames (default: %d).'
+            % MAX_STEPS)
+    parser.add_argument('--no-image-cache', action='store_true',
+            help='Always decode the image files instead of using the '
+            'decoded image cache.')
+    parser.add_argument('--engine', choices=ENGINES, default=ENGINES[0],
+            help='Tube block engine: plain sprites, or slotted entities.')
+    parser.add_argument('--capture', metavar='FILE',
+            help='Capture every frame drawn to FILE, keeping the last ones '
+            'in a ring buffer; list or dump them with capture.py.')
+    parser.add_argument('--capture-frames', type=int, default=CAPTURE_FRAMES,
+            metavar='FRAMES',
+            help='With --capture, number of frames kept (default: %d).'
+            % CAPTURE_FRAMES)
 
     parser.add_argument('-L', '--loglevel', choices=LOG_LEVELS,
             default=DEFAULT_LOG_LEVEL, help='Set the logging level.')
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
+    if args.capture_frames < 1:
+        parser.error('capture frames must be at least 1')
     return args
 
 
-def pause_game(pause=500):
-    """Pause the game.
-    Args:
-        pause: Time, in milliseconds.
+def get_events():
+    """Get the input events for this step.
+    While replaying, the events come from the recording, and only
+    quitting is taken from the keyboard.  While recording, the events
+    are recorded.
+    Returns:
+        List of events.
+    """
+    events = pygame.event.get()
+    if REPLAYER:
+        events = [event for event in events if event.type == pygame.QUIT]
+        events.extend(REPLAYER.events())
+    if RECORDER:
+        RECORDER.record(events)
+    return events
+
+
+def pause_game():
+    """Pause the game until the pause key is pressed again.
+    Sleeps until the next event arrives, rather than polling.
+    Replays do not pause, since the key to continue is not recorded.
     """
-    paused = True
-    while paused:
-        pygame.time.delay(pause)
-        for event in pygame.event.get():
-            if event.type == pygame.KEYDOWN:
-                if event.key == pygame.K_p:
-                    paused = False
+    if REPLAYER:
+        return
+    while True:
+        event = pygame.event.wait()
+        if event.type == pygame.KEYDOWN and event.key == pygame.K_p:
+            break
 
 
-def main():
-    """Main script.
+class Game(object):
+    """One run through the tube.
     """
-    exit_code = 0
-    #To play music, simply select and play
-    #pygame.mixer.music.load('Track1.mp3')
-    #pygame.mixer.music.play()
-
-    backdrop = Background(('far', 'near'), BOARD, -4)
-    y_half = BOARD_HEIGHT / 2
-    player = Player('default', BOARD, DEFAULT_INCREMENT * 5, y_half)
+    def __init__(self, board):
+        """Set up the game.
+        Args:
+            board: PyGame display surface.
+        """
+        #To play music, simply select and play
+        #pygame.mixer.music.load('Track1.mp3')
+        #pygame.mixer.music.play()
+        self.board = board
+        self.backdrop = Background(('far', 'near'), board, -4)
+        y_half = BOARD_HEIGHT / 2
+        self.player = Player('default', board, DEFAULT_INCREMENT * 5, y_half)
 
-    increase_counter = 0
-    enemy_count = DEFAULT_ENEMIES
-    enemies = pygame.sprite.Group()
+        self.increase_counter = 0
+        self.enemy_count = DEFAULT_ENEMIES
+        self.enemies = pygame.sprite.Group()
 
-    tube = BlockTube('sprite', BOARD, -DEFAULT_SPEED)
+        self.tube = BlockTube('sprite', board, -DEFAULT_SPEED)
+        self.game_over = False
 
-    game_over = False
-    while not game_over:
-        BOARD.fill((10, 0, 15))
-        backdrop.update()
+    def step(self):
+        """Advance the game by one simulation step.
+        """
+        player = self.player
+        enemies = self.enemies
+        tube = self.tube
+        self.backdrop.update()
 
         intent = player.get_input()
         player.update()
@@ -457,24 +554,22 @@ def main():
             tube_y = tube.get_y_at_x(player.x_pos + player.width)
             if tube_y:
                 player.y_pos = tube_y + tube.block_height * 3
-        player.display()
 
         if ARGS.enemies:
-            if len(enemies) < enemy_count:
-                new_enemy = Enemy('manta', BOARD)
+            if len(enemies) < self.enemy_count:
+                new_enemy = Enemy('manta', self.board)
                 enemies.add(new_enemy)
 
             enemies_gone = [enemy for enemy in enemies
                             if enemy.x_pos < -enemy.width]
             enemies.remove(enemies_gone)
             enemies.update()
-            enemies.draw(BOARD)
 
             collisions = pygame.sprite.spritecollide(player, enemies, True)
             if collisions:
                 LOGGER.info('Gack!')
                 player.x_pos -= DEFAULT_INCREMENT // 2
-                increase_counter = 0
+                self.increase_counter = 0
 
         if ARGS.tube:
             tube.update()
@@ -490,43 +585,133 @@ def main():
             if collisions:
                 LOGGER.info('Ouch')
                 player.x_pos -= DEFAULT_INCREMENT // 3
-                increase_counter = 0
-            tube.blocks_top.draw(BOARD)
-            tube.blocks_bottom.draw(BOARD)
+                self.increase_counter = 0
 
-        increase_counter += 1
-        if increase_counter > INCREASE_TIME * FRAME_RATE:
-            increase_counter = 0
+        self.increase_counter += 1
+        if self.increase_counter > INCREASE_TIME * FRAME_RATE:
+            self.increase_counter = 0
             player.x_pos += DEFAULT_INCREMENT
-            enemy_count += 1
+            self.enemy_count += 1
 
         if intent == 'quit':
-            game_over = True
+            self.game_over = True
         elif intent == 'pause':
             pause_game()
         if player.x_pos < 0 and not ARGS.infinite:
-            game_over = True
+            self.game_over = True
         elif player.x_pos >= GOAL_X:
             LOGGER.info('OMG, you did it...')
-            game_over = True
+            self.game_over = True
+        if REPLAYER and REPLAYER.finished:
+            self.game_over = True
 
+    def draw(self, alpha=None):
+        """Draw the game on the board.
+        Args:
+            alpha: Fraction of a step to move sprites on from their
+                previous position towards the current one; None draws
+                them at the current position.
+        """
+        self.board.fill((10, 0, 15))
+        self.backdrop.draw()
+        self.player.draw(alpha)
+        groups = []
+        if ARGS.enemies:
+            groups.append(self.enemies)
+        if ARGS.tube:
+            groups.extend((self.tube.blocks_top, self.tube.blocks_bottom))
+        for group in groups:
+            if alpha is None:
+                group.draw(self.board)
+            else:
+                self.board.blits([(sprite.image, sprite.position(alpha))
+                                  for sprite in group], False)
+
+
+def main():
+    """Main script.
+    """
+    exit_code = 0
+    game = Game(BOARD)
+
+    last_time = time.perf_counter()
+    lag = 0.0
+    while not game.game_over:
+        if ARGS.fixed_step:
+            # Run as many steps as the time since the last frame calls
+            # for, but give up on catching up beyond max_steps.
+            now = time.perf_counter()
+            lag += now - last_time
+            last_time = now
+            steps = 0
+            while (lag >= STEP_TIME and steps < ARGS.max_steps
+                   and not game.game_over):
+                game.step()
+                lag -= STEP_TIME
+                steps += 1
+            if lag >= STEP_TIME:
+                lag %= STEP_TIME
+            game.draw(lag / STEP_TIME)
+        else:
+            game.step()
+            game.draw()
+
+        if CAPTURE:
+            CAPTURE.capture(BOARD)
         CLOCK.tick(FRAME_RATE)
         pygame.display.flip()
 
     return exit_code
 
 
-if __name__ == '__main__':
-    ARGS = parse_args()
-    logging.basicConfig(format='%(asctime)s %(levelname)s: %(message)s',
-                        level=getattr(logging, ARGS.loglevel))
+def setup(args):
+    """Set up the globals the game runs on, for the given arguments.
+    Args:
+        args: Arguments, as from parse_args().
+    Raises:
+        OSError: The recording or the capture could not be read or
+            written.
+        ValueError: The recording is not valid.
+    """
+    global ARGS, RECORDER, REPLAYER, BOARD, CLOCK, IMAGES, CAPTURE
+    ARGS = args
+    RECORDER = REPLAYER = None
+    if args.replay:
+        REPLAYER = InputReplayer(args.replay)
+        args.seed = REPLAYER.seed
+    elif args.record:
+        if args.seed is None:
+            args.seed = random.randrange(SEED_MAX)
+        RECORDER = InputRecorder(args.record, args.seed)
+    random.seed(args.seed)
 
     pygame.init()
     BOARD = pygame.display.set_mode(BOARD_SIZE)
+    CAPTURE = (FrameCapture(args.capture, BOARD, args.capture_frames)
+               if args.capture else None)
     CLOCK = pygame.time.Clock()
-    IMAGES = ImageStore(os.path.join(sys.path[0], 'images'), 'png')
+    base_path = os.path.dirname(os.path.abspath(__file__))
+    IMAGES = ImageStore(
+        os.path.join(base_path, 'images'), 'png',
+        cache_path=(None if args.no_image_cache
+                    else default_cache_path(__file__)))
+    IMAGES.preload()
+
+
+if __name__ == '__main__':
+    ARGS = parse_args()
+    logging.basicConfig(format='%(asctime)s %(levelname)s: %(message)s',
+                        level=getattr(logging, ARGS.loglevel))
+    try:
+        setup(ARGS)
+    except (OSError, ValueError) as error:
+        sys.exit(error)
 
     exit_code = main()
+    if RECORDER:
+        RECORDER.close()
+    if CAPTURE:
+        CAPTURE.close()
 
     pygame.quit()
     sys.exit(exit_code)
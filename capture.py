@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+"""Capture of drawn frames to a memory-mapped ring buffer file.
+
+The games copy every frame they draw straight from the board into the
+next slot of a file mapped into memory, with no copy in between, and
+wrap around to the first slot when all are used.  The file so holds the
+last frames drawn, for bug reports and performance regressions, at the
+cost of one memory copy per frame.  Run this module to list the frames
+of a capture or dump some of them to PNG files.
+
+File layout (little-endian):
+    header: magic (4 bytes), version (1 byte), width, height and pitch
+        (4 bytes each), bytes per pixel (1 byte), red, green, blue and
+        alpha masks (4 bytes each), slot count (4 bytes), start time in
+        seconds since the epoch (8-byte float)
+    frame count (8 bytes): frames captured so far
+    slots: frame index (8 bytes), seconds since the start (8-byte
+        float), width and height (4 bytes each), then the pixels, as
+        laid out in the board surface
+"""
+import argparse
+import mmap
+import os
+import struct
+import sys
+import time
+
+os.environ.setdefault('PYGAME_HIDE_SUPPORT_PROMPT', '1')
+import pygame
+
+
+MAGIC = b'JTCP'
+VERSION = 1
+HEADER = struct.Struct('<4sBIIIB4IId')
+COUNT = struct.Struct('<Q')
+FRAME = struct.Struct('<QdII')
+CAPTURE_FRAMES = 300  # Default slot count: 5 s at 60 FPS
+
+
+class FrameCapture(object):
+    """Writes frames into a ring buffer file.
+    """
+    def __init__(self, path, surface, slots=CAPTURE_FRAMES):
+        """Create the file, with room for every slot.
+        Args:
+            path: File to capture to.
+            surface: Surface the frames are drawn on.
+            slots: Number of frames the file holds.
+        Raises:
+            OSError: The file could not be created.
+            ValueError: The surface pixels are not contiguous.
+        """
+        self.count = 0
+        self.slots = slots
+        self._size = surface.get_size()
+        view = surface.get_view('0')
+        self._pixel_size = view.length
+        del view  # Unlocks the surface
+        self._slot_size = FRAME.size + self._pixel_size
+        self._start = time.perf_counter()
+        self._file = open(path, 'w+b')
+        try:
+            self._file.truncate(HEADER.size + COUNT.size
+                                + slots * self._slot_size)
+            self._map = mmap.mmap(self._file.fileno(), 0)
+        except (OSError, ValueError):
+            self._file.close()
+            raise
+        width, height = self._size
+        HEADER.pack_into(self._map, 0, MAGIC, VERSION, width, height,
+                         surface.get_pitch(), surface.get_bytesize(),
+                         *surface.get_masks(), slots, time.time())
+        COUNT.pack_into(self._map, HEADER.size, 0)
+
+    def capture(self, surface):
+        """Copy a frame into the next slot.
+        Args:
+            surface: Surface the frame was drawn on, the same size and
+                format as when the capture started.
+        """
+        offset = (HEADER.size + COUNT.size
+                  + self.count % self.slots * self._slot_size)
+        start = offset + FRAME.size
+        self._map[start:start + self._pixel_size] = surface.get_view('0')
+        FRAME.pack_into(self._map, offset, self.count,
+                        time.perf_counter() - self._start, *self._size)
+        # Count the frame once it is complete, for readers of a live file
+        self.count += 1
+        COUNT.pack_into(self._map, HEADER.size, self.count)
+
+    def close(self):
+        """Finish the capture.
+        """
+        if not self._file.closed:
+            self._map.close()
+            self._file.close()
+
+
+class FrameReader(object):
+    """Reads the frames of a ring buffer file.
+    """
+    def __init__(self, path):
+        """Open a capture.
+        Args:
+            path: File to read.
+        Raises:
+            ValueError: The file is not a capture.
+        """
+        with open(path, 'rb') as capture_file:
+            try:
+                self._map = mmap.mmap(capture_file.fileno(), 0,
+                                      access=mmap.ACCESS_READ)
+            except ValueError:  # Empty file
+                raise ValueError('%s is not a frame capture' % path)
+        if len(self._map) < HEADER.size + COUNT.size:
+            raise ValueError('%s is not a frame capture' % path)
+        (magic, version, self.width, self.height, self.pitch, self.bytesize,
+         red, green, blue, alpha, self.slots,
+         self.start_time) = HEADER.unpack_from(self._map)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError('%s is not a frame capture' % path)
+        self.masks = (red, green, blue, alpha)
+        self._pixel_size = self.pitch * self.height
+        self._slot_size = FRAME.size + self._pixel_size
+        if (len(self._map) < HEADER.size + COUNT.size
+                + self.slots * self._slot_size):
+            raise ValueError('%s is truncated' % path)
+
+    @property
+    def count(self):
+        """Number of frames captured so far, including overwritten ones.
+        """
+        return COUNT.unpack_from(self._map, HEADER.size)[0]
+
+    def frames(self):
+        """Get the frames still in the file, oldest first.
+        Returns:
+            List of (frame index, seconds since the start) tuples.
+        """
+        count = self.count
+        frames = []
+        for index in range(max(0, count - self.slots), count):
+            frame_index, seconds = FRAME.unpack_from(
+                self._map, self._offset(index))[:2]
+            if frame_index == index:  # Not overwritten while reading
+                frames.append((frame_index, seconds))
+        return frames
+
+    def surface(self, index):
+        """Get one frame as a surface.
+        Args:
+            index: Frame index.
+        Returns:
+            Surface, in the format of the board.
+        Raises:
+            KeyError: The frame is not in the file.
+        """
+        offset = self._offset(index)
+        frame_index, _, width, height = FRAME.unpack_from(self._map, offset)
+        if frame_index != index or not 0 <= index < self.count:
+            raise KeyError('frame %d is not in the capture' % index)
+        surface = pygame.Surface((width, height), 0, self.bytesize * 8,
+                                 self.masks)
+        if surface.get_pitch() != self.pitch:
+            raise ValueError('frame %d has an unsupported layout' % index)
+        start = offset + FRAME.size
+        surface.get_buffer().write(self._map[start:start + self._pixel_size])
+        return surface
+
+    def close(self):
+        """Close the file.
+        """
+        self._map.close()
+
+    def _offset(self, index):
+        return (HEADER.size + COUNT.size
+                + index % self.slots * self._slot_size)
+
+
+def parse_frames(text):
+    """Parse a selection of frames, such as "10-20,25".
+    Args:
+        text: Comma-separated frame indexes and ranges of them.
+    Returns:
+        Set of frame indexes.
+    Raises:
+        argparse.ArgumentTypeError: The selection is not valid.
+    """
+    selected = set()
+    try:
+        for part in text.split(','):
+            first, _, last = part.partition('-')
+            first = int(first)
+            last = int(last) if last else first
+            selected.update(range(first, last + 1))
+    except ValueError:
+        raise argparse.ArgumentTypeError('not a frame selection: %r' % text)
+    return selected
+
+
+def main():
+    """List the frames of a capture, or dump them to PNG files.
+    """
+    parser = argparse.ArgumentParser(
+            description='List the frames of a capture, or dump them to PNG '
+            'files.')
+    parser.add_argument('capture', help='Capture file.')
+    parser.add_argument('-d', '--dump', metavar='DIR',
+            help='Write the selected frames to DIR as frame-INDEX.png.')
+    parser.add_argument('-f', '--frames', type=parse_frames,
+            help='Frames to dump, such as "10-20,25" (default: all in the '
+            'file).')
+    args = parser.parse_args()
+    try:
+        reader = FrameReader(args.capture)
+    except (OSError, ValueError) as error:
+        sys.exit(error)
+
+    frames = reader.frames()
+    if args.frames is not None:
+        frames = [frame for frame in frames if frame[0] in args.frames]
+    if not args.dump:
+        print('%dx%d, %d of %d frames in the file, started %s'
+              % (reader.width, reader.height, len(reader.frames()),
+                 reader.count, time.ctime(reader.start_time)))
+        for index, seconds in frames:
+            print('%8d %10.3f s' % (index, seconds))
+    else:
+        os.makedirs(args.dump, exist_ok=True)
+        for index, _ in frames:
+            pygame.image.save(reader.surface(index), os.path.join(
+                args.dump, 'frame-%06d.png' % index))
+        print('%d frames written to %s' % (len(frames), args.dump))
+    reader.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,139 @@
+"""Lightweight entities, for games with many short-lived sprites.
+
+An Entity keeps its attributes in __slots__ rather than a per-instance
+dictionary, and belongs to at most one EntityList, so it needs none of
+the group bookkeeping of pygame.sprite.Sprite.  An EntityList keeps its
+entities in a plain list, and removes one by moving the last entity
+into its place.  Removal is cheap, but does not keep the order.
+
+EntityList has the parts of the pygame.sprite.Group interface that the
+games and the pygame.sprite collision helpers use, such as sprites(),
+kill() and iteration, so entities can stand in for sprites there.
+"""
+
+
+class Entity(object):
+    """Sprite-like object without a per-instance dictionary.
+    Subclasses name their own attributes in __slots__.
+    """
+    __slots__ = ('image', 'rect', 'x_pos', 'y_pos', 'x_prev', 'y_prev',
+                 'width', 'height', '_entity_list', '_index')
+
+    def __init__(self):
+        """Initialize the entity, in no list and without an image.
+        """
+        self.image = self.rect = None
+        self.x_pos = self.y_pos = self.x_prev = self.y_prev = 0
+        self.width = self.height = 0
+        self._entity_list = None
+        self._index = -1
+
+    def alive(self):
+        """Check whether the entity is in a list.
+        Returns:
+            True if it is.
+        """
+        return self._entity_list is not None
+
+    def kill(self):
+        """Remove the entity from its list, if any.
+        """
+        if self._entity_list is not None:
+            self._entity_list.remove(self)
+
+
+class EntityList(object):
+    """Array-backed container of entities.
+    Stands in for pygame.sprite.Group, for entities only.
+    """
+    def __init__(self, *entities):
+        """Initialize the list.
+        Args:
+            entities: Entities to add.
+        """
+        self._entities = []
+        self.add(*entities)
+
+    def __bool__(self):
+        return bool(self._entities)
+
+    def __contains__(self, entity):
+        return entity._entity_list is self
+
+    def __iter__(self):
+        # Over a copy, so entities can be removed while iterating
+        return iter(self._entities[:])
+
+    def __len__(self):
+        return len(self._entities)
+
+    def add(self, *entities):
+        """Add entities, taking them out of any other list.
+        Args:
+            entities: Entities to add.
+        """
+        for entity in entities:
+            if entity._entity_list is not self:
+                if entity._entity_list is not None:
+                    entity._entity_list.remove(entity)
+                entity._entity_list = self
+                entity._index = len(self._entities)
+                self._entities.append(entity)
+
+    def remove(self, *entities):
+        """Remove entities, filling each hole with the last entity.
+        Entities that are not in the list are ignored.
+        Args:
+            entities: Entities to remove.
+        """
+        items = self._entities
+        for entity in entities:
+            if entity._entity_list is self:
+                last = items.pop()
+                if last is not entity:
+                    items[entity._index] = last
+                    last._index = entity._index
+                entity._entity_list = None
+                entity._index = -1
+
+    def has(self, *entities):
+        """Check whether all entities are in the list.
+        Args:
+            entities: Entities to look for.
+        Returns:
+            True if they all are.
+        """
+        return all(entity._entity_list is self for entity in entities)
+
+    def empty(self):
+        """Remove all entities.
+        """
+        for entity in self._entities:
+            entity._entity_list = None
+            entity._index = -1
+        self._entities = []
+
+    def sprites(self):
+        """Get the entities, like pygame.sprite.Group.sprites().
+        Returns:
+            List of entities.
+        """
+        return self._entities[:]
+
+    def update(self, *args, **kwargs):
+        """Call update() on every entity.
+        Args:
+            args, kwargs: Passed to each update().
+        """
+        for entity in self._entities[:]:
+            entity.update(*args, **kwargs)
+
+    def draw(self, surface):
+        """Draw every entity at its rectangle.
+        Args:
+            surface: Surface to draw on.
+        Returns:
+            List of the rectangles drawn.
+        """
+        return surface.blits([(entity.image, entity.rect)
+                              for entity in self._entities])
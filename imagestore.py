@@ -0,0 +1,293 @@
+#!/usr/bin/env python3
+"""Image store shared by the games, with a decoded image cache.
+
+Decoding the PNG files is most of the startup time, so the decoded
+pixels of every image are kept in a single cache file, which is
+memory-mapped on the next start and converted straight from the
+mapping.  Entries whose image file changed since are decoded again, and
+a cache that cannot be read or written is ignored.
+
+File layout (little-endian):
+    header: length of the index (8 bytes)
+    index: JSON object with the cache version, and for every image its
+        offset from the start of the pixels, its size, and the
+        modification time and size of its image file
+    pixels: RGBA pixels of every image, one after another
+"""
+import concurrent.futures
+import json
+import logging
+import mmap
+import os
+import struct
+import tempfile
+import time
+
+import pygame
+
+
+IMAGE_CACHE_PATH = '.image_cache'
+IMAGE_CACHE_VERSION = 2
+# Cache file header: length of the JSON index that follows
+IMAGE_CACHE_HEADER = struct.Struct('<Q')
+LOGGER = logging.getLogger(__name__)
+
+
+def default_cache_path(script):
+    """Get the decoded image cache directory of a game.
+    Args:
+        script: Path of the game script, such as its __file__.
+    Returns:
+        Absolute path of the cache directory, next to the script.
+    """
+    return os.path.join(os.path.dirname(os.path.abspath(script)),
+                        IMAGE_CACHE_PATH)
+
+
+class ImageStore(object):
+    """Image store.
+    """
+    def __init__(self, path, ext='png', cache_path=None):
+        """Initialize the store.
+        Args:
+            path: Path to image files.
+            ext: File extension image files.
+            cache_path: Directory for the decoded image cache, or None to
+                always decode the image files.
+        """
+        self._store = {}
+        self._path = path
+        self._ext = ext
+        self._cache_path = cache_path
+
+    def get(self, name):
+        """Get image object.
+        If the image does not exist in the store, this will also try to
+        add it first, but it is better to pre-add images as there is
+        less delay.
+        Args:
+            name: Name of image to get.
+        Returns:
+            Image object, or None if object could not be found.
+        """
+        if name in self._store:
+            image = self._store[name]
+        else:
+            image = self.add(name)
+        return image
+
+    def add(self, name):
+        """Add image object to the store.
+        Args:
+            name: Name of image to add.
+        Returns:
+            Image object, or None if object could not be loaded.
+        """
+        image_object, _ = self._decode(name)
+        if image_object is not None:
+            image_object = image_object.convert_alpha()
+        self._store[name] = image_object
+        return image_object
+
+    def preload(self, workers=None):
+        """Add every image under the store path that is not added yet.
+        Images still valid in the decoded image cache are taken from
+        there.  The rest are decoded in parallel on a thread pool, and
+        the cache is rewritten.  Converting for the display needs the
+        display, so that is done on this thread.
+        Args:
+            workers: Number of decoding threads; None for the default.
+        Returns:
+            Dictionary of image name to load time, in seconds.
+        """
+        names = [name for name in self.names() if name not in self._store]
+        timings = self.load_cache(names)
+        names = [name for name in names if name not in self._store]
+        with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+            decoded = executor.map(self._decode, names)
+            for name, (image_object, elapsed) in zip(names, decoded):
+                start_time = time.perf_counter()
+                if image_object is not None:
+                    image_object = image_object.convert_alpha()
+                self._store[name] = image_object
+                timings[name] = elapsed + time.perf_counter() - start_time
+                LOGGER.debug('Loaded %s in %.2f ms', name,
+                             timings[name] * 1000)
+        if names:
+            self.save_cache()
+        return timings
+
+    def load_cache(self, names):
+        """Add images from the decoded image cache.
+        Entries whose image file changed since are skipped.  A cache
+        that is missing, of another version or damaged is ignored, and
+        the images are decoded instead.
+        Args:
+            names: Names of images to look for.
+        Returns:
+            Dictionary of added image name to load time, in seconds.
+        """
+        timings = {}
+        if not self._cache_path:
+            return timings
+        cache_path = self._cache_file()
+        try:
+            with open(cache_path, 'rb') as cache_file, \
+                    mmap.mmap(cache_file.fileno(), 0,
+                              access=mmap.ACCESS_READ) as cache:
+                entries, base = self._read_index(cache)
+                names = [name for name in names if name in entries and
+                         entries[name]['stamp'] == self._source_stamp(name)]
+                for name in names:
+                    start_time = time.perf_counter()
+                    image_object = self._from_cache(cache, base, entries[name])
+                    if image_object is None:
+                        LOGGER.error('Image cache %s is truncated',
+                                     cache_path)
+                        break
+                    self._store[name] = image_object
+                    timings[name] = time.perf_counter() - start_time
+                    LOGGER.debug('Loaded %s from cache in %.2f ms', name,
+                                 timings[name] * 1000)
+        except (OSError, ValueError, LookupError, TypeError):
+            LOGGER.debug('No usable image cache at %s', cache_path)
+        return timings
+
+    def save_cache(self):
+        """Write all stored images to the decoded image cache.
+        The cache is written to a temporary file of its own, then moved
+        into place at once, so processes starting together do not write
+        over each other, and readers see either the old cache or the new
+        one.  The cache only speeds startup up, so failing to write it,
+        as in a read-only install, is not an error.
+        Returns:
+            True if the cache was written.
+        """
+        if not self._cache_path:
+            return False
+        temp_path = None
+        try:
+            entries = {}
+            chunks = []
+            offset = 0
+            for name in self.names():
+                image_object = self._store.get(name)
+                if image_object is None:
+                    continue
+                pixels = pygame.image.tobytes(image_object, 'RGBA')
+                chunks.append(pixels)
+                entries[name] = {
+                    'offset': offset,
+                    'size': list(image_object.get_size()),
+                    'stamp': self._source_stamp(name),
+                    }
+                offset += len(pixels)
+            index = json.dumps({'version': IMAGE_CACHE_VERSION,
+                                'images': entries}).encode()
+            os.makedirs(self._cache_path, exist_ok=True)
+            handle, temp_path = tempfile.mkstemp('.tmp', 'images-',
+                                                 self._cache_path)
+            os.chmod(temp_path, 0o644)  # Not just for this user
+            with os.fdopen(handle, 'wb') as cache_file:
+                cache_file.write(IMAGE_CACHE_HEADER.pack(len(index)))
+                cache_file.write(index)
+                cache_file.writelines(chunks)
+            os.replace(temp_path, self._cache_file())
+        except OSError as error:
+            LOGGER.warning('Could not write the image cache: %s', error)
+            if temp_path:
+                try:
+                    os.remove(temp_path)
+                except OSError:
+                    pass
+            return False
+        return True
+
+    def names(self):
+        """Get the names of all images under the store path.
+        Returns:
+            Sorted list of image names, such as 'enemy/manta'.
+        """
+        names = []
+        suffix = '.%s' % self._ext
+        for root, _, files in os.walk(self._path):
+            for file_name in files:
+                if file_name.endswith(suffix):
+                    name = os.path.relpath(os.path.join(root, file_name),
+                                           self._path)
+                    names.append(name[:-len(suffix)].replace(os.sep, '/'))
+        return sorted(names)
+
+    def _cache_file(self):
+        """Get the path of the cache file.
+        """
+        return os.path.join(self._cache_path, 'images.bin')
+
+    @staticmethod
+    def _read_index(cache):
+        """Read the index at the start of the cache file.
+        Args:
+            cache: Memory-mapped cache file.
+        Returns:
+            Tuple: (dictionary of image name to entry, offset of the
+                pixels in the file)
+        Raises:
+            ValueError: The cache is of another version, or damaged.
+        """
+        if len(cache) < IMAGE_CACHE_HEADER.size:
+            raise ValueError('image cache is truncated')
+        length, = IMAGE_CACHE_HEADER.unpack_from(cache)
+        base = IMAGE_CACHE_HEADER.size + length
+        index = json.loads(cache[IMAGE_CACHE_HEADER.size:base])
+        if (not isinstance(index, dict)
+                or index.get('version') != IMAGE_CACHE_VERSION):
+            raise ValueError('image cache is of another version')
+        return index['images'], base
+
+    def _source_stamp(self, name):
+        """Get what identifies the current version of an image file.
+        Returns:
+            List: [modification time in ns, size in bytes]
+        """
+        stat = os.stat(self._image_path(name))
+        return [stat.st_mtime_ns, stat.st_size]
+
+    @staticmethod
+    def _from_cache(cache, base, entry):
+        """Convert cached pixels into an image.
+        Args:
+            cache: Memory-mapped cache file.
+            base: Offset of the pixels in the file.
+            entry: Cache index entry of the image.
+        Returns:
+            Image object, or None if the cache file is too short.
+        """
+        width, height = entry['size']
+        start = base + entry['offset']
+        end = start + width * height * 4
+        if end > len(cache):
+            return None
+        # The view must be gone before the mapping is closed
+        with memoryview(cache) as view, view[start:end] as buffer:
+            image_object = pygame.image.frombuffer(buffer, (width, height),
+                                                   'RGBA').convert_alpha()
+        return image_object
+
+    def _image_path(self, name):
+        """Get the file path of an image.
+        """
+        return os.path.join(self._path, '%s.%s' % (name, self._ext))
+
+    def _decode(self, name):
+        """Decode an image file, without converting it.
+        Returns:
+            Tuple: (image object or None, decoding time in seconds)
+        """
+        image_path = self._image_path(name)
+        start_time = time.perf_counter()
+        try:
+            image_object = pygame.image.load(image_path)
+        except pygame.error:
+            LOGGER.error('Could not load image %s', image_path)
+            image_object = None
+        return image_object, time.perf_counter() - start_time
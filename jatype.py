@@ -2,31 +2,109 @@
 """Terrible test program.
 """
 import argparse
+import collections
+import copy
+import csv
+import json
+import math
 import os
 import random
+import shutil
+import statistics
+import subprocess
 import sys
+import time
+import zlib
 
 import pygame
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import tomllib
+except ImportError:
+    tomllib = None
+
+from capture import CAPTURE_FRAMES, FrameCapture
+from entities import Entity, EntityList
+from imagestore import ImageStore, default_cache_path
+from netplay import (DEFAULT_PORT, NetError, Spectator, host, join,
+                     parse_address)
+from replay import InputRecorder, InputReplayer
+
 
 IMAGE_PATH = 'images'
+ATLAS_KINDS = ('block', 'bonus', 'bullet', 'enemy', 'player')
+ATLAS_SIZE = 256  # Width and height of each atlas surface
+BENCH_RUNS = 5  # Launches per startup benchmark mode
 
 FRAME_RATE = 60
+STEP_TIME = 1.0 / FRAME_RATE  # Simulated time per step, in seconds
+MAX_STEPS = 5  # Steps per rendered frame before the game slows down
+HEADLESS_FRAMES = FRAME_RATE * 60
+HEADLESS_SEED = 0
+SPECTATE_WAIT = 0.1  # Seconds a spectator waits for a snapshot per frame
+SEED_MAX = 2 ** 62
+PROFILE_WINDOW = FRAME_RATE * 10  # Frames of samples kept per phase
+PROFILE_REFRESH = FRAME_RATE // 2  # Frames between overlay redraws
+PROFILE_PHASES = (
+    'input',
+    'player',
+    'enemies',
+    'bonuses',
+    'enemy_bullets',
+    'collide_player',
+    'collide_bullets',
+    'collide_pickups',
+    'collide_bonuses',
+    'publish',
+    'fill',
+    'background',
+    'stats',
+    'sprites',
+    'overlay',
+    'capture',
+    'tick',
+    'flip',
+    'frame',
+    )
+PROFILE_PERCENTILES = (50, 95, 99)
+TEXT_CACHE_SIZE = 32  # Rendered text surfaces kept per cache
 BOARD_WIDTH, BOARD_HEIGHT = BOARD_SIZE = 640, 480
+# Sprites not touching this are entirely off the board
+BOARD_BOUNDS = pygame.Rect(-1, -1, BOARD_WIDTH + 2, BOARD_HEIGHT + 2)
 
 SPEED_MIN = 1
 SPEED_MAX = 6
 SPEED_DEFAULT = 2
 LIVES_MAX = 99
 LIVES_DEFAULT = 3
+NET_PLAYERS = 2  # Players of a network game
+# Colors added to the player images, by player number
+PLAYER_TINTS = ((0, 0, 0), (180, 60, 0))
 HEALTH_DEFAULT = LIVES_DEFAULT
 
+GRID_CELL_SIZE = 64  # Spatial hash cell size, in pixels
+ARRAY_CAPACITY = 64  # Initial entity capacity of an ArrayGroup
+ARRAY_BULK_REMOVE = 8  # Removing over 1/8 of an ArrayGroup compacts it
+ENGINES = ('sprite', 'numpy', 'slots')
+
 ENEMY_MAX = 16
+STRESS_ENEMY_MAX = 1000  # Enemies at a time with --stress
+STRESS_ENEMY_SPAWN = 8  # Enemies added per step with --stress
+STRESS_COUNT_MAX = 4000  # Bullets at a time of every weapon with --stress
+STRESS_FIRE_INTERVAL = FRAME_RATE // 2  # Steps between shots of an enemy
+STRESS_ENEMY_WEAPON = 'fire'  # Weapon enemies fire with --stress
+HOMING_RAMP = FRAME_RATE * 2  # Steps for homing enemies to reach full turn
 ENEMIES = {
     'default': {
         'points': 50,
         'speed': 1,
         'deviation': 8,  # How far up and down an enemy "waves"
+        'pattern': 'wave',  # wave, sine, zigzag, dive or homing
         'strength': 1,
         'bonuses': [],
         },
@@ -34,6 +112,7 @@ ENEMIES = {
         'points': 100,
         'speed': 2,
         'deviation': 0,
+        'pattern': 'wave',
         'strength': 2,  # some enemies are tougher than others...
         'bonuses': [
             'life',
@@ -44,6 +123,7 @@ ENEMIES = {
         'points': 150,
         'speed': 3,
         'deviation': 20,
+        'pattern': 'wave',
         'strength': 1,
         'bonuses': [
             'point'
@@ -100,56 +180,381 @@ WEAPONS = {
         'speed': 7,
         'count_max': 10,
         'strength': 1,
+        'kills_bonuses': False,  # safety bullets do not kill bonuses
         },
     }
 
 
-class ImageStore():
-    """Image store.
+class ContentError(ValueError):
+    """Game content that is not valid.
+    """
+
+
+REQUIRED = object()  # Default of spec fields that must be given
+
+
+class Spec():
+    """Read-only entry of the game content, such as one enemy.
+
+    Subclasses list their fields in FIELDS, as tuples of name, type,
+    default (or REQUIRED) and minimum (or None), and name the same
+    fields in __slots__.  Every spec has an integer ID, its index in
+    the content table, and a name, its key there.
     """
-    def __init__(self, path, ext='png'):
+    __slots__ = ('id', 'name')
+    FIELDS = ()
+    KIND = None  # Image directory of the content
+
+    def __init__(self, spec_id, name, fields):
+        """Initialize the spec.
+
+        Args:
+            spec_id: Index of the spec in its content table.
+            name: Name of the spec.
+            fields: Dictionary of validated field values.
+        """
+        object.__setattr__(self, 'id', spec_id)
+        object.__setattr__(self, 'name', name)
+        for field, value in fields.items():
+            object.__setattr__(self, field, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('%s is read-only' % type(self).__name__)
+
+    def __delattr__(self, name):
+        raise AttributeError('%s is read-only' % type(self).__name__)
+
+    def __repr__(self):
+        return '%s(%d, %r)' % (type(self).__name__, self.id, self.name)
+
+    def replace(self, **fields):
+        """Get a copy of the spec with some fields changed.
+
+        Args:
+            fields: New field values; they are not validated.
+
+        Returns:
+            Spec object.
+        """
+        values = {field[0]: getattr(self, field[0]) for field in self.FIELDS}
+        values.update(fields)
+        return type(self)(self.id, self.name, values)
+
+    @classmethod
+    def validate(cls, where, name, entry):
+        """Check an entry of a content table and fill in its defaults.
+
+        Args:
+            where: Name of the table, for error messages.
+            name: Name of the entry.
+            entry: Dictionary of field values.
+
+        Returns:
+            Dictionary of field values, including defaults.
+
+        Raises:
+            ContentError: The entry is not valid.
+        """
+        where = '%s.%s' % (where, name)
+        if not isinstance(entry, dict):
+            raise ContentError('%s: expected a table' % where)
+        fields = {}
+        known = set()
+        for field, kind, default, minimum in cls.FIELDS:
+            known.add(field)
+            value = entry.get(field, default)
+            if value is REQUIRED:
+                raise ContentError('%s: %s is missing' % (where, field))
+            if field == 'image' and value is None:
+                value = name
+            # bool is an int, but True is not a sensible speed
+            if (not isinstance(value, kind)
+                    or isinstance(value, bool) and kind is not bool):
+                raise ContentError('%s.%s: expected %s, got %r'
+                                   % (where, field, kind.__name__, value))
+            if minimum is not None and value < minimum:
+                raise ContentError('%s.%s: must be at least %d'
+                                   % (where, field, minimum))
+            fields[field] = value
+        unknown = set(entry) - known
+        if unknown:
+            raise ContentError('%s: unknown field %s'
+                               % (where, ', '.join(sorted(unknown))))
+        return fields
+
+
+class WeaponSpec(Spec):
+    """Weapon, and the bullets it fires.
+    """
+    __slots__ = ('cooldown', 'speed', 'count_max', 'strength',
+                 'kills_bonuses', 'image')
+    FIELDS = (
+        ('cooldown', int, REQUIRED, 0),
+        ('speed', int, REQUIRED, 1),
+        ('count_max', int, REQUIRED, 1),
+        ('strength', int, REQUIRED, 1),
+        ('kills_bonuses', bool, True, None),
+        ('image', str, None, None),
+        )
+    KIND = 'bullet'
+
+
+class BonusSpec(Spec):
+    """Bonus that enemies drop.
+    """
+    __slots__ = ('points', 'lives', 'weapons', 'speed', 'image')
+    FIELDS = (
+        ('points', int, REQUIRED, None),
+        ('lives', int, 0, 0),
+        ('weapons', int, 0, 0),  # Gives a random weapon if not 0
+        ('speed', int, REQUIRED, 0),
+        ('image', str, None, None),
+        )
+    KIND = 'bonus'
+
+
+class EnemySpec(Spec):
+    """Enemy.
+    """
+    __slots__ = ('points', 'speed', 'deviation', 'pattern', 'strength',
+                 'bonuses', 'image')
+    FIELDS = (
+        ('points', int, REQUIRED, None),
+        ('speed', int, REQUIRED, 1),
+        ('deviation', int, REQUIRED, 0),
+        ('pattern', str, 'wave', None),
+        ('strength', int, REQUIRED, 1),
+        ('bonuses', list, [], None),
+        ('image', str, None, None),
+        )
+    KIND = 'enemy'
+
+
+class Content():
+    """Enemies, bonuses and weapons, compiled into specs.
+
+    Each table is a tuple of specs indexed by spec ID, with a dictionary
+    of name to ID beside it.  The order is that of the source tables.
+    """
+    def __init__(self, enemies, bonuses, weapons):
+        """Validate and compile content tables.
+
+        Args:
+            enemies: Dictionary of enemy name to fields, like ENEMIES.
+            bonuses: Dictionary of bonus name to fields, like BONUSES.
+            weapons: Dictionary of weapon name to fields, like WEAPONS.
+
+        Raises:
+            ContentError: The content is not valid.
+        """
+        self.weapons, self.weapon_ids = self._compile(
+            WeaponSpec, 'weapons', weapons)
+        self.bonuses, self.bonus_ids = self._compile(
+            BonusSpec, 'bonuses', bonuses)
+        self.enemies, self.enemy_ids = self._compile(
+            EnemySpec, 'enemies', enemies)
+        if 'default' not in self.weapon_ids:
+            raise ContentError('weapons: default is missing')
+
+    @classmethod
+    def load(cls, path):
+        """Load a content pack over the built-in content.
+
+        A pack is a JSON or TOML file with enemies, bonuses and weapons
+        tables, like ENEMIES, BONUSES and WEAPONS.  Fields given for a
+        built-in entry change just those fields; new entries are added.
+
+        Args:
+            path: Path to the pack, ending in .json or .toml.
+
+        Returns:
+            Content object.
+
+        Raises:
+            OSError: The pack could not be read.
+            ValueError: The pack is not valid.
+        """
+        if path.endswith('.toml'):
+            if tomllib is None:
+                raise ContentError('TOML content packs require Python 3.11')
+            with open(path, 'rb') as pack_file:
+                pack = tomllib.load(pack_file)
+        else:
+            with open(path) as pack_file:
+                pack = json.load(pack_file)
+        if not isinstance(pack, dict):
+            raise ContentError('expected a table of content tables')
+        tables = {'enemies': ENEMIES, 'bonuses': BONUSES, 'weapons': WEAPONS}
+        unknown = set(pack) - set(tables)
+        if unknown:
+            raise ContentError('unknown table %s'
+                               % ', '.join(sorted(unknown)))
+        for where, entries in pack.items():
+            if not isinstance(entries, dict):
+                raise ContentError('%s: expected a table' % where)
+            table = {name: dict(entry)
+                     for name, entry in tables[where].items()}
+            for name, entry in entries.items():
+                if not isinstance(entry, dict):
+                    raise ContentError('%s.%s: expected a table'
+                                       % (where, name))
+                table.setdefault(name, {}).update(entry)
+            tables[where] = table
+        return cls(**tables)
+
+    def with_count_max(self, count_max):
+        """Get a copy of the content whose weapons keep more bullets.
+
+        Args:
+            count_max: Bullets at a time that every weapon allows at
+                least.
+
+        Returns:
+            Content object.
+        """
+        content = copy.copy(self)
+        content.weapons = tuple(
+            spec.replace(count_max=max(spec.count_max, count_max))
+            for spec in self.weapons)
+        return content
+
+    def image_names(self):
+        """Get the names of all images the content uses.
+
+        Returns:
+            Set of image names, such as 'enemy/manta'.
+        """
+        return {'%s/%s' % (spec.KIND, spec.image)
+                for table in (self.enemies, self.bonuses, self.weapons)
+                for spec in table}
+
+    def _compile(self, spec_class, where, table):
+        """Compile one content table.
+
+        Args:
+            spec_class: Spec subclass of the entries.
+            where: Name of the table, for error messages.
+            table: Dictionary of entry name to fields.
+
+        Returns:
+            Tuple of the specs and a dictionary of name to spec ID.
+        """
+        if not table:
+            raise ContentError('%s: at least one entry is needed' % where)
+        specs = []
+        for name, entry in table.items():
+            fields = spec_class.validate(where, name, entry)
+            if spec_class is EnemySpec:
+                if fields['pattern'] not in MotionPath.PATTERNS:
+                    raise ContentError('%s.%s.pattern: unknown pattern %r'
+                                       % (where, name, fields['pattern']))
+                bonuses = []
+                for bonus in fields['bonuses']:
+                    if not isinstance(bonus, str):
+                        raise ContentError('%s.%s.bonuses: expected str, '
+                                           'got %r' % (where, name, bonus))
+                    if bonus not in self.bonus_ids:
+                        raise ContentError('%s.%s.bonuses: unknown bonus %r'
+                                           % (where, name, bonus))
+                    bonuses.append(self.bonuses[self.bonus_ids[bonus]])
+                fields['bonuses'] = tuple(bonuses)
+            specs.append(spec_class(len(specs), name, fields))
+        return tuple(specs), {spec.name: spec.id for spec in specs}
+
+
+class AtlasStore(ImageStore):
+    """Image store that can pack images into atlases, and keeps their
+    collision masks.
+    """
+    def __init__(self, path, ext='png', cache_path=None):
         """Initialize the store.
 
         Args:
             path: Path to image files.
             ext: File extension image files.
+            cache_path: Directory for the decoded image cache, or None to
+                always decode the image files.
         """
-        self._store = {}
-        self._path = path
-        self._ext = ext
+        super().__init__(path, ext, cache_path)
+        self._locations = {}
+        self._masks = {}
+        self.atlases = []
 
-    def get(self, name):
-        """Get image object.
+    def mask(self, name):
+        """Get the collision mask of an image.
 
-        If the image does not exist in the store, this will also try to
-        add it first, but it is better to pre-add images as there is
-        less delay.
+        The mask is built from the image alpha the first time, and
+        cached from then on.
 
         Args:
-            name: Name of image to get.
+            name: Name of image to get the mask of.
 
         Returns:
-            Image object, or None if object could not be found.
+            pygame.mask.Mask object.
         """
-        if name in self._store:
-            image = self._store[name]
-        else:
-            image = self.add(name)
-        return image
+        mask = self._masks.get(name)
+        if mask is None:
+            mask = self._masks[name] = pygame.mask.from_surface(
+                self.get(name))
+        return mask
+
+    def build_atlas(self, kinds=ATLAS_KINDS, size=ATLAS_SIZE):
+        """Pack small images into a few large atlas surfaces.
 
-    def add(self, name):
-        """Add image object to the store.
+        Images of the given kinds are added if needed, packed onto
+        shelves of the atlas surfaces, and replaced in the store by
+        subsurfaces of their atlas, so get() still returns images that
+        can be used anywhere.
+
+        Args:
+            kinds: Image kinds (directories) to pack.
+            size: Width and height of each atlas surface.
+
+        Returns:
+            List of atlas surfaces.
+        """
+        names = [name for name in self.names()
+                 if name.split('/')[0] in kinds]
+        images = [(self.get(name), name) for name in names]
+        # Packing tallest first keeps the shelves tight
+        images.sort(key=lambda item: item[0].get_height(), reverse=True)
+        atlas = None
+        shelf_x = shelf_y = shelf_height = 0
+        for image_object, name in images:
+            width, height = image_object.get_size()
+            if width > size or height > size:
+                continue
+            if shelf_x + width > size:
+                # Start a new shelf
+                shelf_x = 0
+                shelf_y += shelf_height + 1
+                shelf_height = height
+            if atlas is None or shelf_y + height > size:
+                atlas = pygame.Surface((size, size), pygame.SRCALPHA)
+                atlas = atlas.convert_alpha()
+                atlas.fill((0, 0, 0, 0))
+                self.atlases.append(atlas)
+                shelf_x = shelf_y = 0
+                shelf_height = height
+            rect = pygame.Rect(shelf_x, shelf_y, width, height)
+            # Copy pixels and alpha as they are, instead of blending
+            atlas.blit(image_object, rect, special_flags=pygame.BLEND_RGBA_MAX)
+            self._store[name] = atlas.subsurface(rect)
+            self._locations[name] = (atlas, rect)
+            shelf_x += width + 1
+        return self.atlases
+
+    def locate(self, name):
+        """Get where an image is in the atlas.
 
         Args:
-            name: Name of image to add.
+            name: Name of image to find.
 
         Returns:
-            Image object, or None if object could not be loaded.
+            Tuple: (atlas surface, rectangle), or None if the image is not
+            in an atlas.
         """
-        image_path = os.path.join(self._path, '%s.%s' % (name, self._ext))
-        image_object = pygame.image.load(image_path).convert_alpha()
-        self._store[name] = image_object
-        return image_object
+        return self._locations.get(name)
 
 
 class Character(pygame.sprite.Sprite):
@@ -166,66 +571,107 @@ class Character(pygame.sprite.Sprite):
         """
         super().__init__()
         self.kind = kind
-        self.name = name
-        self.speed = speed
+        self.name = None
+        self.image = self.rect = self.mask = None
+        self.reinit(name, x_pos, y_pos, speed)
+
+    def reinit(self, name, x_pos=0, y_pos=0, speed=SPEED_DEFAULT):
+        """Reset the character to a freshly initialized state.
 
-        self.image = IMAGES.get('%s/%s' % (kind, name))
-        self.width, self.height = self.image.get_size()
+        The image is only looked up again if the name changed, so
+        recycled characters of the same name cost no allocations.
+        The collision mask is only set with --pixel-perfect.
 
-        # Fetch the rectangle object that has the dimensions of the image
-        self.rect = self.image.get_rect()
-        self.rect.x = self.x_pos = x_pos
-        self.rect.y = self.y_pos = y_pos
+        Args:
+            name: Specific name of character.
+            x_pos: X coordinate of character.
+            y_pos: Y coordinate of character.
+            speed: Speed of character.
+        """
+        self.speed = speed
+        if name != self.name:
+            self.name = name
+            image_name = '%s/%s' % (self.kind, name)
+            self.image = IMAGES.get(image_name)
+            # Masks are only used by --pixel-perfect, and backgrounds
+            # never collide
+            if ARGS.pixel_perfect and self.kind != 'background':
+                self.mask = IMAGES.mask(image_name)
+            self.width, self.height = self.image.get_size()
+            if self.rect is None:
+                # Fetch the rectangle object that has the dimensions of
+                # the image
+                self.rect = self.image.get_rect()
+            else:
+                self.rect.size = self.width, self.height
+        self.rect.x = self.x_prev = self.x_pos = x_pos
+        self.rect.y = self.y_prev = self.y_pos = y_pos
         self.x_inc = self.y_inc = 0
 
     def display(self):
         """Draw the character image on the game board.
         """
-        BOARD.blit(self.image, (self.x_pos, self.y_pos))
+        rect = BOARD.blit(self.image, (self.x_pos, self.y_pos))
+        if RENDERER:
+            RENDERER.mark(rect)
 
     def update(self):
         """Update sprite.
         """
+        self.x_prev = self.x_pos
+        self.y_prev = self.y_pos
         self.x_pos += self.x_inc
         self.y_pos += self.y_inc
         self.rect.x = self.x_pos
         self.rect.y = self.y_pos
-        self.display()
 
 
 class Player(Character):
     """Player class.
     """
-    def __init__(self, name='default', x_pos=0, y_pos=0):
+    def __init__(self, name='default', x_pos=BOARD_WIDTH // 2,
+                 y_pos=BOARD_HEIGHT // 2, number=0):
         """Initialize player.
 
         Args:
             name:
-            x_pos:
-            y_pos:
+            x_pos: X coordinate the player starts from.
+            y_pos: Y coordinate the player starts from.
+            number: Index of the player in the game, which picks the
+                tint of the image.
         """
         super().__init__('player', name, x_pos, y_pos)
+        self.home = x_pos, y_pos
+        self.number = number
         self.weapons = {}  # dictionary of weapons, and how many of each
         self.weapon_index = 0
         self.weapon = None
+        self.weapon_spec = None
         self.cooldown = None
         self.cooldown_left = 0
         self.invulnerability = 0  # Player is invulnerable when starting out
         self.reset(weapons=True, position=True)
 
-        self.image_orig = self.image  # invulnerability makes player blink
-        self.image_alt = pygame.transform.laplacian(self.image)
+        # invulnerability makes player blink
+        self.image_orig, self.image_alt = player_images(name, number)
+        self.image = self.image_orig
 
         self.lives = LIVES_DEFAULT
         self.score = 0
-        self.bullets = pygame.sprite.Group()
+        self.bullets = new_group()
 
 
-    def get_input(self):
+    def get_input(self, events):
         """Get input from the user (keyboard)
+
+        Args:
+            events: Input events of the player for this step.
+
+        Returns:
+            True if the player quit.
         """
         game_over = False
-        for event in pygame.event.get():
+        for event in events:
             if event.type == pygame.QUIT:
                 game_over = True
             elif event.type == pygame.KEYDOWN:
@@ -233,6 +679,8 @@ class Player(Character):
                     game_over = True
                 elif event.key == pygame.K_p:
                     pause_game()
+                elif event.key == pygame.K_F3:
+                    PROFILER.overlay = not PROFILER.overlay
                 elif event.key == pygame.K_x:
                     if self.speed < SPEED_MAX:
                         self.speed += 1
@@ -268,8 +716,7 @@ class Player(Character):
         """
         self.invulnerability = FRAME_RATE * 5
         if position:
-            self.x_pos = BOARD_WIDTH // 2
-            self.y_pos = BOARD_HEIGHT // 2
+            self.x_pos, self.y_pos = self.home
         if weapons:
             self.weapons = {'default': 1}
             self.weapon_index = 0
@@ -286,15 +733,16 @@ class Player(Character):
         if self.weapon_index >= len(self.weapons):
             self.weapon_index = 0
         self.weapon = sorted(self.weapons.keys())[self.weapon_index]
-        self.cooldown = WEAPONS[self.weapon]['cooldown']
+        self.weapon_spec = CONTENT.weapons[CONTENT.weapon_ids[self.weapon]]
+        self.cooldown = self.weapon_spec.cooldown
         self.cooldown_left = 0
 
     def shoot(self):
         """Shoot weapon.
         """
-        if (self.cooldown_left < 1 and
-                len(self.bullets) < WEAPONS[self.weapon]['count_max']):
-            speed = WEAPONS[self.weapon]['speed']
+        spec = self.weapon_spec
+        if self.cooldown_left < 1 and len(self.bullets) < spec.count_max:
+            speed = spec.speed
             directions = (
                 (speed, 0),
                 (speed, speed // 2 or 1),
@@ -307,9 +755,8 @@ class Player(Character):
                 )
             guns = self.weapons[self.weapon]
             for x_inc, y_inc in directions[:guns]:
-                bullet = Bullet(self.weapon, self.x_pos, self.y_pos,
-                                x_inc=x_inc, y_inc=y_inc)
-                bullet.strength = WEAPONS[self.weapon]['strength']
+                bullet = BULLET_POOL.acquire(spec, self.x_pos, self.y_pos,
+                                             x_inc=x_inc, y_inc=y_inc)
                 self.bullets.add(bullet)
             self.cooldown_left += self.cooldown
 
@@ -341,79 +788,292 @@ class Player(Character):
                 self.image = self.image_orig
         super().update()
         self.bullets.update()
-        useless = [bullet for bullet in self.bullets
-                   if bullet.x_pos > BOARD_WIDTH
-                   or bullet.x_pos < -bullet.width
-                   or bullet.y_pos > BOARD_HEIGHT
-                   or bullet.y_pos < -bullet.height]
-        for bullet in useless:
-            self.bullets.remove(bullet)
+        release_offscreen(self.bullets, BULLET_POOL)
+
+    def hit(self):
+        """Lose a level of the current weapon, or a life with the last.
+        """
+        self.weapons[self.weapon] -= 1
+        if self.weapons[self.weapon] < 1:
+            self.weapons.pop(self.weapon, None)
+            self.weapon_index = 0
+        if not self.weapons:
+            self.lives -= 1
+            self.reset(weapons=True)
+        self.equip()
 
 
 class Bullet(Character):
     """Bullet class.
     """
-    def __init__(self, name, x_pos, y_pos, x_inc, y_inc):
+    def __init__(self, spec, x_pos, y_pos, x_inc, y_inc):
         """Initialize bullets.
+
+        Args:
+            spec: WeaponSpec of the weapon that fired the bullet.
+        """
+        super().__init__('bullet', spec.image, x_pos, y_pos, 0)
+        self.respawn(spec, x_pos, y_pos, x_inc, y_inc)
+
+    def respawn(self, spec, x_pos, y_pos, x_inc, y_inc):
+        """Reset bullet, so a spent one can be fired again.
         """
-        super().__init__('bullet', name, x_pos, y_pos, 0)
-        self.strength = WEAPONS[self.name]['strength']
+        self.reinit(spec.image, x_pos, y_pos, 0)
+        self.spec = spec
+        self.strength = spec.strength
         self.x_inc = x_inc
         self.y_inc = y_inc
 
 
+class BulletEntity(Entity):
+    """Bullet without a per-instance dictionary, for the slots engine.
+
+    It behaves the same as Bullet, whose methods it shares, but is much
+    smaller, and lives in an EntityList instead of a sprite group.
+    """
+    __slots__ = ('kind', 'name', 'mask', 'speed', 'x_inc', 'y_inc', 'spec',
+                 'strength', 'pooled')
+
+    reinit = Character.reinit
+    display = Character.display
+    update = Character.update
+    respawn = Bullet.respawn
+
+    def __init__(self, spec, x_pos, y_pos, x_inc, y_inc):
+        """Initialize bullets.
+
+        Args:
+            spec: WeaponSpec of the weapon that fired the bullet.
+        """
+        super().__init__()
+        self.kind = 'bullet'
+        self.name = self.mask = None
+        self.respawn(spec, x_pos, y_pos, x_inc, y_inc)
+
+
+class MotionPath():
+    """Precomputed vertical movement of one kind of enemy.
+
+    The movement is a table with one offset per phase, which enemies
+    look up with their own phase counter instead of working out their
+    movement every step.  For most patterns the offsets are heights
+    relative to where the enemy came in, mirrored for enemies that head
+    up first.  For homing, they are how far the enemy may turn toward
+    the player in that phase.
+
+    Patterns:
+        wave: Up and down at the enemy speed, past the deviation.
+        sine: Smooth up and down, as far as the deviation.
+        zigzag: Like wave, but twice as steep.
+        dive: Level flight into the board, then a dive off it.
+        homing: Turns toward the player, ever faster.
+    """
+    PATTERNS = ('wave', 'sine', 'zigzag', 'dive', 'homing')
+    paths = []  # Every path built, by index
+    _built = {}
+    _arrays = None
+
+    def __init__(self, pattern, speed, deviation):
+        """Build the path.
+
+        Args:
+            pattern: Name of the movement pattern.
+            speed: Speed of the enemy.
+            deviation: How far up and down the enemy moves.
+
+        Raises:
+            ValueError: The pattern is unknown.
+        """
+        if pattern not in self.PATTERNS:
+            raise ValueError('unknown motion pattern %r' % pattern)
+        self.pattern = pattern
+        self.homing = pattern == 'homing'
+        offsets, self.loop = getattr(self, '_' + pattern)(speed, deviation)
+        self.offsets = tuple(offsets)
+        self.index = len(MotionPath.paths)
+        MotionPath.paths.append(self)
+
+    @classmethod
+    def for_enemy(cls, spec):
+        """Get the path of an enemy, building it the first time.
+
+        Args:
+            spec: EnemySpec of the enemy.
+
+        Returns:
+            MotionPath object.
+        """
+        key = spec.pattern, spec.speed, spec.deviation
+        path = cls._built.get(key)
+        if path is None:
+            path = cls._built[key] = cls(*key)
+        return path
+
+    @classmethod
+    def arrays(cls):
+        """Get every path as NumPy arrays, for moving enemies in bulk.
+
+        Returns:
+            Tuple of the offsets, one row per path index padded with
+            its last offset, and the length, loop and homing flag of
+            each path.
+        """
+        paths = cls.paths
+        if cls._arrays is None or len(cls._arrays[1]) != len(paths):
+            width = max(len(path.offsets) for path in paths)
+            offsets = numpy.array(
+                [path.offsets + path.offsets[-1:] * (width - len(path.offsets))
+                 for path in paths], numpy.int64)
+            cls._arrays = (
+                offsets,
+                numpy.array([len(path.offsets) for path in paths],
+                            numpy.int64),
+                numpy.array([path.loop for path in paths]),
+                numpy.array([path.homing for path in paths]))
+        return cls._arrays
+
+    def advance(self, phase):
+        """Get the phase after the given one.
+
+        Args:
+            phase: Current phase.
+
+        Returns:
+            Next phase; paths that do not loop stay on their last one.
+        """
+        phase += 1
+        if phase == len(self.offsets):
+            phase = 0 if self.loop else phase - 1
+        return phase
+
+    def restart(self, phase, sign):
+        """Get where to pick the path up again at a new height.
+
+        Enemies on a looping path carry on in the direction they were
+        heading; the others start over.
+
+        Args:
+            phase: Current phase.
+            sign: 1 if the offsets are used as they are, -1 if mirrored.
+
+        Returns:
+            Tuple of the new phase and sign.
+        """
+        if self.loop:
+            offsets = self.offsets
+            step = offsets[(phase + 1) % len(offsets)] - offsets[phase]
+            if step < 0:
+                sign = -sign
+        return 0, sign
+
+    @staticmethod
+    def _wave(speed, deviation):
+        """Triangle wave that turns one step past the deviation.
+        """
+        if not deviation:
+            return [0], True
+        steps = -(-deviation // speed) + 1  # Steps from middle to top
+        offsets = ([speed * phase for phase in range(steps)]
+                   + [speed * (2 * steps - phase)
+                      for phase in range(steps, 3 * steps)]
+                   + [speed * (phase - 4 * steps)
+                      for phase in range(3 * steps, 4 * steps)])
+        return offsets, True
+
+    @staticmethod
+    def _sine(speed, deviation):
+        """Sine wave with the period of the triangle wave.
+        """
+        if not deviation:
+            return [0], True
+        period = 4 * (-(-deviation // speed) + 1)
+        return [int(round(deviation * math.sin(2 * math.pi * phase / period)))
+                for phase in range(period)], True
+
+    @classmethod
+    def _zigzag(cls, speed, deviation):
+        """Triangle wave at twice the vertical speed.
+        """
+        return cls._wave(speed * 2, deviation)
+
+    @staticmethod
+    def _dive(speed, deviation):
+        """Level until about a board width in, then an accelerating dive.
+        """
+        offsets = [0] * (BOARD_WIDTH // speed)
+        fall = speed
+        while offsets[-1] <= BOARD_HEIGHT:
+            offsets.append(offsets[-1] + fall)
+            fall += 1
+        return offsets, False
+
+    @staticmethod
+    def _homing(speed, deviation):
+        """Turn rate toward the player, up to the enemy speed.
+        """
+        return [speed * phase // HOMING_RAMP
+                for phase in range(HOMING_RAMP + 1)], False
+
+
 class Enemy(Character):
     """Enemy class.
     """
-    def __init__(self, name=None):
+    def __init__(self, spec=None):
         """Initialize enemy.
 
         Args:
-            name: Enemy name; if None, random from ENEMIES
-            x_pos:
-            y_pos:
+            spec: EnemySpec; if None, random from the content
+        """
+        if not spec:
+            spec = random.choice(CONTENT.enemies)
+        super().__init__('enemy', spec.image, x_pos=0, y_pos=0,
+                         speed=spec.speed)
+        self.respawn(spec)
+
+    def respawn(self, spec=None):
+        """Reset enemy, so a dead one can be sent in again.
+
+        Args:
+            spec: EnemySpec; if None, random from the content
         """
-        if not name:
-            names = list(ENEMIES.keys())
-            name = random.choice(names)
-        speed = ENEMIES[name]['speed']
-        super().__init__('enemy', name, x_pos=0, y_pos=0, speed=speed)
-        self.points = ENEMIES[name]['points']
+        if not spec:
+            spec = random.choice(CONTENT.enemies)
+        self.reinit(spec.image, speed=spec.speed)
+        self.spec = spec
+        self.points = spec.points
         self.x_inc = -self.speed
-        self.direction = random.choice(['up', 'down'])
-        self.deviation = ENEMIES[name]['deviation']
-        self.strength = ENEMIES[name]['strength']
-        self.bonuses = ENEMIES[name]['bonuses']
+        self.path = MotionPath.for_enemy(spec)
+        self.phase = 0
+        self.sign = random.choice((-1, 1))  # Head up or down first
+        self.strength = spec.strength
+        self.bonuses = spec.bonuses
         self.reset()
-        self.y_initial = self.y_pos
 
     def reset(self):
         """Reset position to randomly off the right side of the screen.
         """
         self.x_pos = random.randint(BOARD_WIDTH, BOARD_WIDTH * 2)
         self.y_pos = self.y_initial = random.randint(0, BOARD_HEIGHT)
+        # Jumping back is not movement to draw in between
+        self.x_prev = self.x_pos
+        self.y_prev = self.y_pos
+        self.phase, self.sign = self.path.restart(self.phase, self.sign)
 
-    def update(self):
-        if self.deviation:
-            ## Enemy will wave up and down
-            if self.direction == 'up':
-                self.y_inc = -self.speed
-                if self.y_pos <= self.y_initial - self.deviation:
-                    self.direction = 'down'
-            else:
-                self.y_inc = self.speed
-                if self.y_pos >= self.y_initial + self.deviation:
-                    self.direction = 'up'
-        #else:
-        #    ## Else it is 'default' behavior: head toward player
-        #    if player.x_pos < self.x_pos:
-        #        self.x_pos -= self.speed
-
-        #    if player.y_pos < self.y_pos:
-        #        self.y_pos -= self.speed
-        #    else:
-        #        self.y_pos += self.speed
+    def update(self, player=None):
+        """Update enemy.
 
+        Args:
+            player: Player, for homing enemies to head for.
+        """
+        path = self.path
+        self.phase = phase = path.advance(self.phase)
+        if not path.homing:
+            self.y_inc = (self.y_initial + self.sign * path.offsets[phase]
+                          - self.y_pos)
+        elif player:
+            turn = path.offsets[phase]
+            target = player.y_pos + (player.height - self.height) // 2
+            self.y_inc = max(-turn, min(turn, target - self.y_pos))
         super().update()
         if self.x_pos < -self.width:
             self.reset()
@@ -422,122 +1082,1125 @@ class Enemy(Character):
 class Bonus(Character):
     """Bonus class.
     """
-    def __init__(self, name=None, x_pos=0, y_pos=0):
+    def __init__(self, spec=None, x_pos=0, y_pos=0):
         """Initialize bonus.
+
+        Args:
+            spec: BonusSpec; if None, random from the content
+        """
+        if not spec:
+            spec = random.choice(CONTENT.bonuses)
+        super().__init__('bonus', spec.image, x_pos, y_pos, spec.speed)
+        self.respawn(spec, x_pos, y_pos)
+
+    def respawn(self, spec=None, x_pos=0, y_pos=0):
+        """Reset bonus, so a collected one can be dropped again.
         """
-        if not name:
-            names = list(BONUSES.keys())
-            name = random.choice(names)
-        speed = BONUSES[name]['speed']
-        super().__init__('bonus', name, x_pos, y_pos, speed)
+        if not spec:
+            spec = random.choice(CONTENT.bonuses)
+        self.reinit(spec.image, x_pos, y_pos, spec.speed)
+        self.spec = spec
         self.x_inc = random.randint(-self.speed, self.speed)
         self.y_inc = random.randint(-self.speed, self.speed)
-        if name == 'weapon':
-            weapons = list(WEAPONS.keys())
-            self.weapon = random.choice(weapons)
+        if spec.weapons:
+            self.weapon = random.choice(CONTENT.weapons).name
         else:
             self.weapon = None
-        self.points = BONUSES[name]['points']
-        self.lives = BONUSES[name]['lives']
+        self.points = spec.points
+        self.lives = spec.lives
+
+
+class SpritePool():
+    """Free list of reusable sprites of a single class.
+
+    The class must provide respawn(), taking the same arguments as its
+    constructor, to reset a recycled sprite.
+    """
+    def __init__(self, sprite_class):
+        """Initialize the pool.
+
+        Args:
+            sprite_class: Class of the pooled sprites.
+        """
+        self.sprite_class = sprite_class
+        self.hits = 0
+        self.misses = 0
+        self._free = []
+
+    def acquire(self, *args, **kwargs):
+        """Get a sprite, recycling a released one if possible.
+
+        Args:
+            args, kwargs: Passed to the constructor or respawn().
+
+        Returns:
+            Sprite object.
+        """
+        if self._free:
+            self.hits += 1
+            sprite = self._free.pop()
+            sprite.respawn(*args, **kwargs)
+        else:
+            self.misses += 1
+            sprite = self.sprite_class(*args, **kwargs)
+        sprite.pooled = False
+        return sprite
+
+    def release(self, sprite):
+        """Remove a sprite from all groups and keep it for reuse.
+
+        Releasing a sprite that is already released does nothing.
+
+        Args:
+            sprite: Sprite to release.
+        """
+        if not sprite.pooled:
+            sprite.pooled = True
+            sprite.kill()
+            self._free.append(sprite)
+
+    def release_all(self, sprites, group):
+        """Release many sprites of one group at once.
+
+        The sprites are removed with a single call, which groups can
+        do in bulk, so they must be in no other group.
+
+        Args:
+            sprites: Sprites to release.
+            group: Group the sprites are in.
+        """
+        sprites = [sprite for sprite in sprites if not sprite.pooled]
+        for sprite in sprites:
+            sprite.pooled = True
+        group.remove(*sprites)
+        self._free.extend(sprites)
+
+
+CONTENT = Content(ENEMIES, BONUSES, WEAPONS)
+BULLET_POOL = SpritePool(Bullet)
+ENEMY_POOL = SpritePool(Enemy)
+BONUS_POOL = SpritePool(Bonus)
 
 
 class Background():
     """Backgrounds.  Yes, plural.
     """
-    def __init__(self, levels, x_inc=0, y_inc=0):
+    def __init__(self, levels, x_inc=0, y_inc=0, interval=1):
         """Initialize scrolling background object.
 
+        Each level is pre-tiled once into a surface big enough to hold
+        any wrapped-around view of it, so drawing a level is one blit.
+
         Args:
             levels: A single background name, or list of backgrounds.
+            interval: Frames between scroll steps; 0 never scrolls.
         """
         if not isinstance(levels, (list, tuple)):
             levels = [levels]
+        self.interval = interval
+        self.frame = 0
         self.levels = []
+        self.tiles = []
+        self.areas = []
         for incr, level in enumerate(levels):
             background = Character('background', level, 0, 0)
             background.display()
             background.x_inc = x_inc + int(x_inc * (incr + 1) / len(levels))
             background.y_inc = y_inc + int(y_inc * (incr + 1) / len(levels))
             self.levels.append(background)
+            self.tiles.append(self.build_tile(background))
+            self.areas.append(pygame.Rect((0, 0), BOARD_SIZE))
 
-    def update(self):
-        """Update backgrounds.
+    @staticmethod
+    def build_tile(level):
+        """Composite copies of a level into one wrap-around surface.
+
+        Args:
+            level: Background level character.
+
+        Returns:
+            Surface with the level repeated to cover the board, plus one
+            more copy in each direction the level scrolls.
         """
+        columns = -(-BOARD_WIDTH // level.width) + bool(level.x_inc)
+        rows = -(-BOARD_HEIGHT // level.height) + bool(level.y_inc)
+        tile = pygame.Surface((level.width * columns, level.height * rows),
+                              pygame.SRCALPHA)
+        for column in range(columns):
+            for row in range(rows):
+                tile.blit(level.image,
+                          (column * level.width, row * level.height))
+        # Layers without transparency blit faster without an alpha channel
+        opaque = pygame.mask.from_surface(level.image, 254).count()
+        if opaque == level.width * level.height:
+            tile = tile.convert()
+        else:
+            tile = tile.convert_alpha()
+        return tile
+
+    def scroll(self):
+        """Move backgrounds, if it is time to.
+
+        Returns:
+            True if the backgrounds moved.
+        """
+        self.frame += 1
+        if not self.interval or self.frame % self.interval:
+            return False
         for level in self.levels:
-            level.update()
+            level.x_pos += level.x_inc
+            level.y_pos += level.y_inc
             if level.x_pos <= -level.width or level.x_pos >= level.width:
                 level.x_pos = 0
             if level.y_pos <= -level.height or level.y_pos >= level.height:
                 level.y_pos = 0
+        return True
+
+    def draw(self, surface):
+        """Draw backgrounds.
+
+        Args:
+            surface: Surface to draw on.
+        """
+        for level, tile, area in zip(self.levels, self.tiles, self.areas):
+            area.x = -level.x_pos % level.width
+            area.y = -level.y_pos % level.height
+            surface.blit(tile, (0, 0), area)
+
+
+
+class DirtyRenderer():
+    """Sends only the changed parts of the game board to the display.
+
+    Everything drawn on the board is marked here.  The next frame, those
+    areas are restored from a cached backdrop instead of redrawing the
+    whole board, and only the old and new areas are updated on screen.
+    The backdrop is only redrawn when the backgrounds scroll.
+    """
+    def __init__(self, color=(10, 0, 15)):
+        """Initialize the renderer.
+
+        Args:
+            color: Board color behind the backgrounds.
+        """
+        self.color = color
+        self.backdrop = pygame.Surface(BOARD_SIZE).convert()
+        self.full = True
+        self._invalid = True
+        self._drawn = []
+        self._marked = []
+
+    def invalidate(self):
+        """Redraw and update the whole board next frame.
+        """
+        self._invalid = True
+
+    def mark(self, rect):
+        """Mark an area of the board as changed this frame.
+
+        Args:
+            rect: Changed area.
+        """
+        self._marked.append(rect)
+
+    def clear(self, background, moved):
+        """Start a frame by erasing what was drawn over the backdrop.
+
+        Args:
+            background: Background object.
+            moved: The background scrolled since the last frame.
+        """
+        if moved or self._invalid:
+            self.backdrop.fill(self.color)
+            background.draw(self.backdrop)
+            BOARD.blit(self.backdrop, (0, 0))
+            self.full = True
+            self._invalid = False
+        else:
+            backdrop = self.backdrop
+            for rect in self._drawn:
+                BOARD.blit(backdrop, rect, rect)
+            self.full = False
+
+    def present(self, show=True):
+        """Finish a frame by updating the changed parts of the display.
+
+        Args:
+            show: Actually update the display.
+        """
+        if show:
+            if self.full:
+                pygame.display.flip()
+            else:
+                pygame.display.update(self._drawn + self._marked)
+        self._drawn = self._marked
+        self._marked = []
+
+
+class ArrayGroup(pygame.sprite.Group):
+    """Sprite group that moves its sprites as NumPy arrays.
+
+    Positions, velocities and sizes live in contiguous arrays, one slot
+    per sprite, kept in step with group membership.  update() moves
+    every sprite along its motion path and resets them with array
+    operations instead of a Python method call per sprite.  The
+    sprites' own attributes are only written back for drawing,
+    collisions and on removal.
+    """
+    FIELDS = ('x', 'y', 'x_inc', 'y_inc', 'width', 'height', 'path',
+              'phase', 'sign', 'y_initial', 'order')
+
+    def __init__(self, *sprites, wave=False):
+        """Initialize the group.
+
+        Args:
+            sprites: Sprites to add.
+            wave: Move the sprites like enemies (along their motion
+                paths, wrapping around) rather than in a straight line.
+        """
+        self.wave = wave
+        self._count = 0
+        self._added = 0
+        self._sprites = []
+        self._slots = {}
+        self._resets = []
+        self._arrays = {field: numpy.zeros(ARRAY_CAPACITY, numpy.int64)
+                        for field in self.FIELDS}
+        super().__init__(*sprites)
+
+    def add_internal(self, sprite, layer=None):
+        """Add a sprite and give it a slot in the arrays.
+        """
+        super().add_internal(sprite, layer)
+        slot = self._count
+        if slot == len(self._arrays['x']):
+            for field, array in self._arrays.items():
+                self._arrays[field] = numpy.resize(array, slot * 2)
+        arrays = self._arrays
+        arrays['x'][slot] = sprite.x_pos
+        arrays['y'][slot] = sprite.y_pos
+        arrays['x_inc'][slot] = sprite.x_inc
+        arrays['y_inc'][slot] = sprite.y_inc
+        arrays['width'][slot] = sprite.width
+        arrays['height'][slot] = sprite.height
+        arrays['order'][slot] = self._added
+        if self.wave:
+            arrays['path'][slot] = sprite.path.index
+            arrays['phase'][slot] = sprite.phase
+            arrays['sign'][slot] = sprite.sign
+            arrays['y_initial'][slot] = sprite.y_initial
+        self._added += 1
+        self._slots[sprite] = slot
+        self._sprites.append(sprite)
+        self._count += 1
+
+    def remove_internal(self, sprite):
+        """Remove a sprite, writing its array state back to it.
+        """
+        super().remove_internal(sprite)
+        slot = self._slots.pop(sprite)
+        arrays = self._arrays
+        sprite.x_inc = int(arrays['x_inc'][slot])
+        sprite.y_inc = int(arrays['y_inc'][slot])
+        if self.wave:
+            sprite.phase = int(arrays['phase'][slot])
+            sprite.sign = int(arrays['sign'][slot])
+            sprite.y_initial = int(arrays['y_initial'][slot])
+        last = self._count - 1
+        if slot != last:
+            # Move the last sprite into the hole
+            for array in arrays.values():
+                array[slot] = array[last]
+            moved = self._sprites[last]
+            self._sprites[slot] = moved
+            self._slots[moved] = slot
+        self._sprites.pop()
+        self._count = last
+
+    def remove(self, *sprites):
+        """Remove sprites, compacting the arrays once for all of them.
+
+        Removing a few sprites fills each hole with the last sprite, as
+        remove_internal() does; removing many keeps the rest in order
+        and renumbers their slots.
+        """
+        slots = self._slots
+        gone = [sprite for sprite in sprites if sprite in slots]
+        count = self._count
+        if len(gone) * ARRAY_BULK_REMOVE <= count:
+            super().remove(*gone)
+            return
+        arrays = self._arrays
+        keep = numpy.ones(count, bool)
+        for sprite in gone:
+            pygame.sprite.AbstractGroup.remove_internal(self, sprite)
+            sprite.remove_internal(self)
+            slot = slots[sprite]
+            keep[slot] = False
+            sprite.x_inc = int(arrays['x_inc'][slot])
+            sprite.y_inc = int(arrays['y_inc'][slot])
+            if self.wave:
+                sprite.phase = int(arrays['phase'][slot])
+                sprite.sign = int(arrays['sign'][slot])
+                sprite.y_initial = int(arrays['y_initial'][slot])
+        kept = numpy.flatnonzero(keep)
+        self._count = len(kept)
+        for array in arrays.values():
+            array[:self._count] = array[kept]
+        self._sprites = [self._sprites[slot] for slot in kept.tolist()]
+        self._slots = {sprite: slot
+                       for slot, sprite in enumerate(self._sprites)}
+
+    def update(self, player=None):
+        """Move every sprite in the group.
+
+        Args:
+            player: Player, for homing enemies to head for.
+        """
+        count = self._count
+        if not count:
+            return
+        arrays = {field: array[:count]
+                  for field, array in self._arrays.items()}
+        x_pos, y_pos = arrays['x'], arrays['y']
+        for sprite in self._resets:
+            slot = self._slots.get(sprite)
+            if slot is not None:
+                x_pos[slot] = sprite.x_pos
+                y_pos[slot] = sprite.y_pos
+        self._resets = []
+
+        if self.wave:
+            offsets, lengths, loops, homing = MotionPath.arrays()
+            path = arrays['path']
+            phase = arrays['phase']
+            phase += 1
+            ended = numpy.flatnonzero(phase == lengths[path])
+            if len(ended):
+                phase[ended] = numpy.where(loops[path[ended]], 0,
+                                           phase[ended] - 1)
+            offset = offsets[path, phase]
+            target = arrays['y_initial'] + arrays['sign'] * offset
+            homing = homing[path]
+            if homing.any():
+                if player:
+                    aim = (player.y_pos
+                           + (player.height - arrays['height']) // 2)
+                    steered = y_pos + numpy.clip(aim - y_pos, -offset, offset)
+                else:
+                    steered = y_pos
+                target = numpy.where(homing, steered, target)
+            arrays['y_inc'][:] = target - y_pos
+        x_pos += arrays['x_inc']
+        y_pos += arrays['y_inc']
+
+        sprites = self._sprites
+        for sprite, sprite_x, sprite_y in zip(sprites, x_pos.tolist(),
+                                              y_pos.tolist()):
+            sprite.x_prev = sprite.x_pos
+            sprite.y_prev = sprite.y_pos
+            sprite.x_pos = sprite.rect.x = sprite_x
+            sprite.y_pos = sprite.rect.y = sprite_y
+
+        if self.wave:
+            gone = numpy.flatnonzero(x_pos < -arrays['width'])
+            if len(gone):
+                # Reset in group order, so the random numbers drawn are
+                # the same as with plain sprites.  The arrays keep the
+                # old positions, like the rectangles, until next update.
+                gone = [sprites[slot] for slot in gone]
+                gone.sort(key=lambda sprite: arrays['order'][
+                    self._slots[sprite]])
+                for sprite in gone:
+                    slot = self._slots[sprite]
+                    sprite.phase = int(arrays['phase'][slot])
+                    sprite.sign = int(arrays['sign'][slot])
+                    sprite.reset()
+                    arrays['y_initial'][slot] = sprite.y_pos
+                    arrays['phase'][slot] = sprite.phase
+                    arrays['sign'][slot] = sprite.sign
+                self._resets = gone
+
+    def offscreen(self):
+        """Get sprites that are entirely off the game board.
+
+        Returns:
+            List of sprites.
+        """
+        count = self._count
+        arrays = self._arrays
+        x_pos = arrays['x'][:count]
+        y_pos = arrays['y'][:count]
+        outside = ((x_pos > BOARD_WIDTH) | (x_pos < -arrays['width'][:count])
+                   | (y_pos > BOARD_HEIGHT)
+                   | (y_pos < -arrays['height'][:count]))
+        return [self._sprites[slot] for slot in numpy.flatnonzero(outside)]
+
+    def groupcollide(self, group):
+        """Array version of pygame.sprite.groupcollide(group, self).
+
+        Args:
+            group: Another ArrayGroup to test against this one.
+
+        Returns:
+            Dictionary of each sprite in group to the list of sprites in
+            this group it collides with, for sprites with collisions.
+        """
+        hits = {}
+        if not self._count or not group._count:
+            return hits
+        mine = {field: array[:self._count]
+                for field, array in self._arrays.items()}
+        theirs = {field: array[:group._count, numpy.newaxis]
+                  for field, array in group._arrays.items()}
+        # Same test as pygame.Rect.colliderect(), for every pair
+        touching = ((theirs['x'] < mine['x'] + mine['width'])
+                    & (mine['x'] < theirs['x'] + theirs['width'])
+                    & (theirs['y'] < mine['y'] + mine['height'])
+                    & (mine['y'] < theirs['y'] + theirs['height'])
+                    & (mine['width'] > 0) & (mine['height'] > 0)
+                    & (theirs['width'] > 0) & (theirs['height'] > 0))
+        rows = numpy.flatnonzero(touching.any(axis=1))
+        rows = rows[numpy.argsort(theirs['order'][rows, 0], kind='stable')]
+        for row in rows.tolist():
+            columns = numpy.flatnonzero(touching[row])
+            columns = columns[numpy.argsort(mine['order'][columns],
+                                            kind='stable')]
+            hits[group._sprites[row]] = [self._sprites[column]
+                                         for column in columns.tolist()]
+        return hits
+
+
+class SpatialHash():
+    """Uniform grid over the game board, for broadphase collisions.
+
+    Sprites are bucketed by the cells their rectangles cover; sprites
+    off the board are clamped into the edge cells, so nothing is missed.
+    Collision results are ordered as pygame.sprite would order them.
+    """
+    def __init__(self, cell_size=GRID_CELL_SIZE):
+        """Initialize the grid.
+
+        Args:
+            cell_size: Width and height of a cell, in pixels.
+        """
+        self.cell_size = cell_size
+        self.columns = -(-BOARD_WIDTH // cell_size)
+        self.rows = -(-BOARD_HEIGHT // cell_size)
+        self._cells = {}
+        self._order = {}
+
+    def _cells_for(self, rect):
+        """Get the cell keys covered by a rectangle.
+
+        Args:
+            rect: Rectangle to look up.
+
+        Returns:
+            List of cell keys.
+        """
+        size = self.cell_size
+        last_column = self.columns - 1
+        last_row = self.rows - 1
+        left = min(max(rect.left // size, 0), last_column)
+        right = min(max((rect.right - 1) // size, 0), last_column)
+        top = min(max(rect.top // size, 0), last_row)
+        bottom = min(max((rect.bottom - 1) // size, 0), last_row)
+        if left == right and top == bottom:
+            return [top * self.columns + left]
+        return [row * self.columns + column
+                for row in range(top, bottom + 1)
+                for column in range(left, right + 1)]
+
+    def rebuild(self, sprites):
+        """Replace the grid contents.
+
+        Args:
+            sprites: Iterable of sprites (usually a group) to hash.
+        """
+        cells = self._cells = {}
+        order = self._order = {}
+        for index, sprite in enumerate(sprites):
+            order[sprite] = index
+            for cell in self._cells_for(sprite.rect):
+                if cell in cells:
+                    cells[cell].append(sprite)
+                else:
+                    cells[cell] = [sprite]
+
+    def remove(self, sprite):
+        """Remove a sprite from the grid.
 
-            if level.x_inc:
-                BOARD.blit(
-                    level.image,
-                    (
-                        level.x_pos - cmp(level.x_inc, 0) * level.width,
-                        level.y_pos
-                        )
-                    )
-            if level.y_inc:
-                BOARD.blit(
-                    level.image,
-                    (
-                        level.x_pos,
-                        level.y_pos - cmp(level.y_inc, 0) * level.height
-                        )
-                    )
-                # If movement is diagonal, a fourth copy is required
-                if level.x_inc:
-                    BOARD.blit(
-                        level.image,
-                        (
-                            level.x_pos - cmp(level.x_inc, 0) * level.width,
-                            level.y_pos - cmp(level.y_inc, 0) * level.height
-                            )
-                        )
-
-
-def parse_args():
+        Args:
+            sprite: Sprite to remove.
+        """
+        if self._order.pop(sprite, None) is not None:
+            for cell in self._cells_for(sprite.rect):
+                self._cells[cell].remove(sprite)
+
+    def query(self, rect):
+        """Get all hashed sprites colliding with a rectangle.
+
+        Args:
+            rect: Rectangle to test.
+
+        Returns:
+            List of colliding sprites, in hashing order.
+        """
+        cells = self._cells
+        keys = self._cells_for(rect)
+        if len(keys) == 1:
+            return [sprite for sprite in cells.get(keys[0], ())
+                    if rect.colliderect(sprite.rect)]
+        found = set()
+        for key in keys:
+            for sprite in cells.get(key, ()):
+                if sprite not in found and rect.colliderect(sprite.rect):
+                    found.add(sprite)
+        return sorted(found, key=self._order.__getitem__)
+
+    def spritecollide(self, sprite, dokill=False):
+        """Grid version of pygame.sprite.spritecollide().
+
+        Args:
+            sprite: Sprite to test against the hashed sprites.
+            dokill: Kill the hashed sprites that were hit.
+
+        Returns:
+            List of colliding sprites.
+        """
+        collided = self.query(sprite.rect)
+        if dokill:
+            for other in collided:
+                self.remove(other)
+                other.kill()
+        return collided
+
+    def groupcollide(self, group):
+        """Grid version of pygame.sprite.groupcollide(group, hashed).
+
+        Args:
+            group: Sprites to test against the hashed sprites.
+
+        Returns:
+            Dictionary of each sprite in group to the list of hashed
+            sprites it collides with, for sprites with collisions only.
+        """
+        hits = {}
+        for sprite in group:
+            collided = self.query(sprite.rect)
+            if collided:
+                hits[sprite] = collided
+        return hits
+
+
+class FrameProfiler():
+    """Times each phase of the main loop.
+
+    Every phase keeps a rolling window of its most recent samples, from
+    which the percentiles are computed on demand.
+    """
+    def __init__(self, window=PROFILE_WINDOW):
+        """Initialize the profiler.
+
+        Args:
+            window: Number of samples to keep per phase.
+        """
+        self.samples = {phase: collections.deque(maxlen=window)
+                        for phase in PROFILE_PHASES}
+        self.frames = 0
+        self.overlay = False
+        self._overlay_font = None
+        self._overlay_image = None
+        self._frame_start = self._lap_start = time.perf_counter()
+
+    def start(self):
+        """Mark the start of a frame.
+        """
+        self._frame_start = self._lap_start = time.perf_counter()
+
+    def lap(self, phase):
+        """Record the time spent since the previous lap.
+
+        Args:
+            phase: Name of the phase that just finished.
+        """
+        now = time.perf_counter()
+        self.samples[phase].append(now - self._lap_start)
+        self._lap_start = now
+
+    def stop(self):
+        """Mark the end of a frame.
+        """
+        now = time.perf_counter()
+        self.samples['frame'].append(now - self._frame_start)
+        self.frames += 1
+
+    def percentiles(self):
+        """Get the current percentiles of every phase.
+
+        Returns:
+            Dictionary of phase name to a dictionary of statistics, in
+            milliseconds.
+        """
+        stats = {}
+        for phase in PROFILE_PHASES:
+            samples = sorted(self.samples[phase])
+            phase_stats = {}
+            for percent in PROFILE_PERCENTILES:
+                if samples:
+                    index = min(len(samples) - 1,
+                                len(samples) * percent // 100)
+                    value = samples[index] * 1000
+                else:
+                    value = 0.0
+                phase_stats['p%d_ms' % percent] = value
+            if samples:
+                phase_stats['mean_ms'] = sum(samples) * 1000 / len(samples)
+            else:
+                phase_stats['mean_ms'] = 0.0
+            stats[phase] = phase_stats
+        return stats
+
+    def dump(self, path):
+        """Write the percentiles to a file.
+
+        Args:
+            path: Output file; CSV if it ends in .csv, otherwise JSON.
+        """
+        stats = self.percentiles()
+        with open(path, 'w', newline='') as out_file:
+            if path.lower().endswith('.csv'):
+                fields = ['phase'] + list(stats['frame'])
+                writer = csv.DictWriter(out_file, fieldnames=fields)
+                writer.writeheader()
+                for phase, phase_stats in stats.items():
+                    writer.writerow(dict(phase_stats, phase=phase))
+            else:
+                json.dump({'frames': self.frames, 'phases': stats},
+                          out_file, indent=2)
+
+    def draw(self):
+        """Draw the percentile overlay, if enabled.
+        """
+        if not self.overlay:
+            return
+        if self._overlay_image is None or not self.frames % PROFILE_REFRESH:
+            lines = ['%-16s %6s %6s %6s' % ('ms', 'p50', 'p95', 'p99')]
+            for phase, phase_stats in self.percentiles().items():
+                lines.append('%-16s %6.2f %6.2f %6.2f' % (
+                    phase, phase_stats['p50_ms'], phase_stats['p95_ms'],
+                    phase_stats['p99_ms']))
+            if self._overlay_font is None:
+                # Columns only line up with a fixed-width font
+                self._overlay_font = pygame.font.SysFont('monospace', 12)
+            font = self._overlay_font
+            line_height = font.get_linesize()
+            width = max(font.size(line)[0] for line in lines)
+            self._overlay_image = pygame.Surface(
+                (width, line_height * len(lines)))
+            for index, line in enumerate(lines):
+                self._overlay_image.blit(
+                    font.render(line, True, (0, 255, 0), (0, 0, 0)),
+                    (0, index * line_height))
+        rect = BOARD.blit(self._overlay_image,
+                          (0, BOARD_HEIGHT - self._overlay_image.get_height()))
+        if RENDERER:
+            RENDERER.mark(rect)
+
+
+class TextCache():
+    """Rendered text surfaces, so unchanged text is never rendered twice.
+
+    The most recently used surfaces are kept, up to a fixed number.
+    """
+    def __init__(self, font, size=TEXT_CACHE_SIZE):
+        """Initialize the cache.
+
+        Args:
+            font: Font to render with.
+            size: Maximum number of surfaces to keep.
+        """
+        self.font = font
+        self.size = size
+        self._store = collections.OrderedDict()
+
+    def render(self, text, color, background=None):
+        """Get a surface with the text on it.
+
+        Args:
+            text: Text to render (single line).
+            color: Text color.
+            background: Background color; None is transparent.
+
+        Returns:
+            Surface object.
+        """
+        key = (text, color, background)
+        if key in self._store:
+            self._store.move_to_end(key)
+            image = self._store[key]
+        else:
+            image = self.font.render(text, True, color, background)
+            self._store[key] = image
+            if len(self._store) > self.size:
+                self._store.popitem(last=False)
+        return image
+
+
+def bench_startup(runs=BENCH_RUNS):
+    """Compare how long the game takes to start with each image source.
+
+    Each mode launches a headless one-frame game several times:
+    cold rebuilds the decoded image cache on every launch, warm decodes
+    the image files (already in the OS file cache), and cached loads the
+    decoded image cache.
+
+    Args:
+        runs: Launches per mode.
+    """
+    script = os.path.abspath(__file__)
+    cache_path = default_cache_path(script)
+    command = [sys.executable, script, '--headless', '--frames', '1']
+    modes = (
+        ('cold', [], True),
+        ('warm', ['--no-image-cache'], False),
+        ('cached', [], False),
+        )
+    for mode, options, clear in modes:
+        times = []
+        for _ in range(runs):
+            if clear:
+                shutil.rmtree(cache_path, ignore_errors=True)
+            start_time = time.perf_counter()
+            subprocess.run(command + options, check=True,
+                           stdout=subprocess.DEVNULL,
+                           stderr=subprocess.DEVNULL)
+            times.append(time.perf_counter() - start_time)
+        print('%-7s median %7.1f ms  min %7.1f ms'
+              % (mode, statistics.median(times) * 1000, min(times) * 1000))
+
+
+def draw_sprites(groups, alpha=None):
+    """Draw sprites on the game board in a single batch.
+
+    Args:
+        groups: Sequence of sprite groups (or other iterables of
+            sprites), drawn in order.
+        alpha: Fraction of a step to move sprites on from their previous
+            position towards the current one; None draws them at the
+            current position.
+    """
+    batch = []
+    if alpha is None:
+        for group in groups:
+            batch.extend([(sprite.image, sprite.rect) for sprite in group])
+    else:
+        for group in groups:
+            batch.extend([
+                (sprite.image,
+                 (sprite.x_prev + (sprite.x_pos - sprite.x_prev) * alpha,
+                  sprite.y_prev + (sprite.y_pos - sprite.y_prev) * alpha))
+                for sprite in group])
+    if RENDERER:
+        for rect in BOARD.blits(batch):
+            RENDERER.mark(rect)
+    elif hasattr(BOARD, 'fblits'):  # Only in some pygame versions
+        BOARD.fblits(batch)
+    else:
+        BOARD.blits(batch, False)
+
+
+def player_images(name, number=0):
+    """Get the images of a player, tinted by player number.
+
+    Args:
+        name: Name of the player image.
+        number: Index of the player in the game.
+
+    Returns:
+        Tuple: (image, image shown while blinking)
+    """
+    image = IMAGES.get('player/%s' % name)
+    if number:
+        image = image.copy()
+        image.fill(PLAYER_TINTS[number], special_flags=pygame.BLEND_RGB_ADD)
+    return image, pygame.transform.laplacian(image)
+
+
+def pixel_collide(sprite, others):
+    """Narrow rectangle contacts down to those of opaque pixels.
+
+    Args:
+        sprite: Sprite, with a rect and a mask.
+        others: Sprites whose rectangles collide with that of sprite.
+
+    Returns:
+        List of the sprites in others whose masks overlap that of
+        sprite.
+    """
+    return [other for other in others
+            if pygame.sprite.collide_mask(sprite, other)]
+
+
+def pixel_hits(hits):
+    """Narrow a dictionary of rectangle contacts down to pixel ones.
+
+    Args:
+        hits: Dictionary of sprite to the list of sprites it collides
+            with, as from groupcollide().
+
+    Returns:
+        Dictionary like hits, without the sprites that have no pixel
+        contacts left.
+    """
+    narrowed = {}
+    for sprite, others in hits.items():
+        others = pixel_collide(sprite, others)
+        if others:
+            narrowed[sprite] = others
+    return narrowed
+
+
+def release_offscreen(group, pool):
+    """Release the sprites of a group that are entirely off the board.
+
+    Args:
+        group: Group of sprites to check, in no other group.
+        pool: SpritePool to release them to.
+    """
+    if isinstance(group, ArrayGroup):
+        gone = group.offscreen()
+    else:
+        sprites = group.sprites()
+        inside = BOARD_BOUNDS.collidelistall(
+            [sprite.rect for sprite in sprites])
+        if len(inside) == len(sprites):
+            return
+        inside = set(inside)
+        gone = [sprite for index, sprite in enumerate(sprites)
+                if index not in inside]
+    if gone:
+        pool.release_all(gone, group)
+
+
+def new_group(wave=False):
+    """Create a sprite group for the selected engine.
+
+    Args:
+        wave: Group holds enemies, which follow motion paths.
+
+    Returns:
+        Group object, or EntityList for bullets of the slots engine.
+    """
+    if ARGS.engine == 'numpy':
+        group = ArrayGroup(wave=wave)
+    elif ARGS.engine == 'slots' and not wave:
+        group = EntityList()
+    else:
+        group = pygame.sprite.Group()
+    return group
+
+
+def parse_args(argv=None):
     """Parse user arguments and return as parser object.
 
+    Args:
+        argv: Arguments to parse; None for the command line.
+
     Returns:
         Parser object with arguments as attributes.
     """
     parser = argparse.ArgumentParser(description='Test basic functionality.')
     parser.add_argument('-i', '--infinite', action='store_true',
                         help='Enable infinite mode (no deaths).')
-    args = parser.parse_args()
+    parser.add_argument('--headless', action='store_true',
+                        help='Run without a window and without the frame '
+                        'rate cap, then report simulation speed.')
+    parser.add_argument('-f', '--frames', type=int,
+                        help='Stop after this many frames (headless default: '
+                        '%d, or the whole replay).' % HEADLESS_FRAMES)
+    parser.add_argument('-s', '--seed', type=int,
+                        help='Seed the random number generator (headless '
+                        'default: %d).' % HEADLESS_SEED)
+    parser.add_argument('--load-times', action='store_true',
+                        help='Print how long each image took to load.')
+    parser.add_argument('--no-image-cache', action='store_true',
+                        help='Always decode the image files instead of using '
+                        'the decoded image cache.')
+    parser.add_argument('--bench-startup', action='store_true',
+                        help='Time cold, warm and cached launches, then '
+                        'exit.')
+    parser.add_argument('-a', '--atlas', action='store_true',
+                        help='Pack sprite images into shared atlas surfaces.')
+    parser.add_argument('--fixed-step', action='store_true',
+                        help='Simulate at a fixed rate however fast frames '
+                        'are drawn, drawing sprites between steps.')
+    parser.add_argument('--max-steps', type=int, default=MAX_STEPS,
+                        metavar='STEPS',
+                        help='With --fixed-step, most steps to simulate per '
+                        'drawn frame before slowing down; 1 never skips '
+                        'frames (default: %d).' % MAX_STEPS)
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument('-r', '--record', metavar='FILE',
+                        help='Record the random seed and all input to '
+                        'FILE.')
+    source.add_argument('-R', '--replay', metavar='FILE',
+                        help='Replay the input recorded in FILE; use the '
+                        'same options as when recording.')
+    source.add_argument('--host', type=int, nargs='?', const=DEFAULT_PORT,
+                        metavar='PORT',
+                        help='Host a two-player game on PORT, waiting for '
+                        'the other player to join; spectators may join '
+                        'too (default port: %d).' % DEFAULT_PORT)
+    source.add_argument('--join', metavar='HOST[:PORT]',
+                        help='Join a two-player game as the second player; '
+                        'the options that change the game must be those '
+                        'of the host.')
+    source.add_argument('--spectate', metavar='HOST[:PORT]',
+                        help='Watch a two-player game hosted on HOST.')
+    parser.add_argument('-c', '--content', metavar='FILE',
+                        help='Load a content pack of enemies, bonuses and '
+                        'weapons from FILE (JSON, or TOML if FILE ends in '
+                        '.toml) over the built-in content.')
+    parser.add_argument('-p', '--profile', metavar='FILE',
+                        help='Write per-phase frame timings to FILE on exit '
+                        '(CSV if FILE ends in .csv, JSON otherwise).')
+    parser.add_argument('--capture', metavar='FILE',
+                        help='Capture every frame drawn to FILE, keeping the '
+                        'last ones in a ring buffer; list or dump them with '
+                        'capture.py.')
+    parser.add_argument('--capture-frames', type=int, default=CAPTURE_FRAMES,
+                        metavar='FRAMES',
+                        help='With --capture, number of frames kept '
+                        '(default: %d).' % CAPTURE_FRAMES)
+    parser.add_argument('-e', '--engine', choices=ENGINES,
+                        help='Entity engine: plain sprites, NumPy arrays '
+                        'for bullets and enemies, or slotted entities for '
+                        'bullets (default: numpy with --stress if NumPy is '
+                        'installed, otherwise %s).' % ENGINES[0])
+    parser.add_argument('--pixel-perfect', action='store_true',
+                        help='Only count collisions where opaque pixels '
+                        'overlap, not just the image rectangles.')
+    parser.add_argument('--stress', action='store_true',
+                        help='Bullet hell: up to %d enemies that fire back, '
+                        'and up to %d bullets per weapon.'
+                        % (STRESS_ENEMY_MAX, STRESS_COUNT_MAX))
+    parser.add_argument('-d', '--dirty', action='store_true',
+                        help='Only update the changed parts of the screen.')
+    parser.add_argument('--scroll-interval', type=int, default=1,
+                        metavar='FRAMES',
+                        help='Frames between background scroll steps; 0 '
+                        'keeps the background still (default: 1).')
+    args = parser.parse_args(argv)
+    if args.engine is None:
+        args.engine = 'numpy' if args.stress and numpy else ENGINES[0]
+    if args.engine == 'numpy' and numpy is None:
+        parser.error('the numpy engine requires NumPy')
+    if args.capture_frames < 1:
+        parser.error('capture frames must be at least 1')
+    for name in ('join', 'spectate'):
+        address = getattr(args, name)
+        if address is not None:
+            try:
+                setattr(args, name, parse_address(address))
+            except ValueError:
+                parser.error('not an address: %r' % address)
+    if args.headless:
+        if args.frames is None and not args.replay:
+            args.frames = HEADLESS_FRAMES
+        if args.seed is None:
+            args.seed = HEADLESS_SEED
     return args
 
 
-def cmp(one, two):
-    """Re-implementing removed cmp() function.
+def get_events():
+    """Get the input events for this step.
+
+    While replaying, the events come from the recording, and only
+    quitting is taken from the keyboard.  While recording, the events
+    are recorded.
+
+    Returns:
+        List of events.
     """
-    if one > two:
-        result = 1
-    elif one < two:
-        result = -1
-    else:
-        result = 0
-    return result
+    events = pygame.event.get()
+    if REPLAYER:
+        events = [event for event in events if event.type == pygame.QUIT]
+        events.extend(REPLAYER.events())
+    if RECORDER:
+        RECORDER.record(events)
+    return events
 
 
-def show_stats(lives, score, weapons):
+def show_stats(lives, score, weapons, line=0):
     """Show stats
+
+    Args:
+        lives: Lives left.
+        score: Score.
+        weapons: Names of the weapons; None to leave them out.
+        line: Line to show the stats on, one per player.
+    """
+    text = 'Lives: %d  Score: %06d' % (lives, score)
+    if weapons is not None:
+        weapon_stat = ''
+        for weapon in sorted(weapons):
+            weapon_stat += weapon[0]  # Just show first letter of each weapon
+        text += '  Weapons: %s' % weapon_stat
+    stats = STATS_TEXT.render(text, (0, 0, 0), (255, 255, 255))
+    rect = BOARD.blit(stats, (0, line * stats.get_height()))
+    if RENDERER:
+        RENDERER.mark(rect)
+
+
+def net_image_table(players=NET_PLAYERS):
+    """Get the image table of the snapshots sent to spectators.
+
+    Every player has two entries, with and without blinking, followed
+    by the content images in name order.
+
+    Args:
+        players: Number of players.
+
+    Returns:
+        List of [image name, player number or None, blinking] lists.
     """
-    weapon_stat = ''
-    for weapon in sorted(weapons):
-        weapon_stat += weapon[0]  # Just show first letter of each weapon
-    stats = GAME_FONT.render(
-        'Lives: %d  Score: %06d  Weapons: %s' % (lives, score, weapon_stat),
-        True, (0, 0, 0), (255, 255, 255))
-    BOARD.blit(stats, (0, 0))
+    table = []
+    for number in range(players):
+        table.extend((['player/default', number, False],
+                      ['player/default', number, True]))
+    table.extend([name, None, False]
+                 for name in sorted(CONTENT.image_names()))
+    return table
+
+
+def net_rules(args):
+    """Get the options that change a network game.
+
+    Both players must play with the same ones, or their games would
+    drift apart.
+
+    Args:
+        args: Arguments, as from parse_args().
+
+    Returns:
+        Dictionary of option values, with a checksum of the content
+        pack file, if any.
+    """
+    content = None
+    if args.content:
+        with open(args.content, 'rb') as content_file:
+            content = zlib.crc32(content_file.read())
+    return {'infinite': args.infinite, 'stress': args.stress,
+            'pixel_perfect': args.pixel_perfect, 'frames': args.frames,
+            'content': content}
 
 
 def show_text(text, timer=-1, size=48, color=(255, 255, 0), py_key='any'):
     """Display text on screen for a given amount of time
     """
-    text_pic = GAME_FONT.render(text, 1, color)
+    text_pic = TEXT_CACHE.render(text, color)
     # Center the input text (single line)
     half_size = (len(text) / 2) * (size / 3)
     # Position the text (single line) in the center of the screen
@@ -545,6 +2208,8 @@ def show_text(text, timer=-1, size=48, color=(255, 255, 0), py_key='any'):
     BOARD.blit(text_pic, text_position)
     pygame.display.flip()
     wait_for_keypress(py_key, timer)
+    if RENDERER:
+        RENDERER.invalidate()
 
 
 def wait_for_keypress(py_key='any', timer=-1):
@@ -555,145 +2220,650 @@ def wait_for_keypress(py_key='any', timer=-1):
         timer: Amount of time to wait, in seconds.  -1 is infinite.
     """
     pygame.event.clear()
-    while timer != 0:
-        pygame.time.wait(1000)
-        CLOCK.tick(10)
-        if timer > 0:
-            timer -= 1
-        for event in pygame.event.get():
-            if event.type == pygame.KEYDOWN:
-                if py_key in ('any', event.key):
-                    timer = 0
+    if timer == 0:
+        return
+    deadline = pygame.time.get_ticks() + timer * 1000
+    while True:
+        # Sleep until the next event, rather than polling
+        if timer < 0:
+            event = pygame.event.wait()
+        else:
+            remaining = deadline - pygame.time.get_ticks()
+            if remaining <= 0:
+                break
+            event = pygame.event.wait(remaining)
+        if event.type == pygame.KEYDOWN:
+            if py_key in ('any', event.key):
+                break
 
 
 def pause_game():
     """Pause the game until the pause key is pressed again.
+
+    Replays do not pause, since the key to continue is not recorded,
+    and neither do network games, which the other player drives on.
     """
+    if REPLAYER or NETPLAY:
+        return
     show_text('Paused', py_key=pygame.K_p)
 
 
-def main():
-    """The game itself.
+# Outcome of a contact in a step, for scoring and effects.  kind is one
+# of 'hit', 'crash', 'kill', 'drop', 'pickup' and 'shoot_bonus', name is
+# that of the spec of the enemy, bonus or enemy bullet involved, and
+# player the index of the player who scores the points.
+GameEvent = collections.namedtuple(
+    'GameEvent', ('kind', 'name', 'x_pos', 'y_pos', 'points', 'player'))
+
+
+class Game():
+    """One game: the players, the enemies and bonuses, and the rules.
     """
-    exit_code = 0
-    # To play music, simply select and play
-    #pygame.mixer.music.load('Track1.mp3')
-    #pygame.mixer.music.play()
-    background = Background(('far', 'near'), x_inc=-2, y_inc=-1)
-    enemies = pygame.sprite.Group()
-    bonuses = pygame.sprite.Group()
-    player = Player()
-
-    game_over = False
-    while not game_over:
-        BOARD.fill((10, 0, 15))
-        # blit the backdrops first
-        background.update()
-        show_stats(player.lives, player.score, player.weapons.keys())
-
-        game_over = player.get_input()
-        player.update()
+    def __init__(self, players=1):
+        """Initialize the game.
+
+        Args:
+            players: Number of players, who share the board; the game
+                is over when any of them is.
+        """
+        # To play music, simply select and play
+        #pygame.mixer.music.load('Track1.mp3')
+        #pygame.mixer.music.play()
+        self.background = Background(('far', 'near'), x_inc=-2, y_inc=-1,
+                                     interval=ARGS.scroll_interval)
+        self.background_moved = True
+        self.enemies = new_group(wave=True)
+        self.enemy_bullets = new_group()
+        self.bonuses = pygame.sprite.Group()
+        self.players = [
+            Player(x_pos=BOARD_WIDTH // 2,
+                   y_pos=BOARD_HEIGHT * (number + 1) // (players + 1),
+                   number=number)
+            for number in range(players)]
+        self.player = self.players[0]
+        if ARGS.stress:
+            self.enemy_max = STRESS_ENEMY_MAX
+            self.enemy_spawn = STRESS_ENEMY_SPAWN
+            self.enemy_weapon = CONTENT.weapons[
+                CONTENT.weapon_ids[STRESS_ENEMY_WEAPON]]
+        else:
+            self.enemy_max = ENEMY_MAX
+            self.enemy_spawn = 1
+            self.enemy_weapon = None
+        self.enemy_grid = SpatialHash()
+        self.bullet_grid = SpatialHash()
+        self.bonus_grid = SpatialHash()
+        self.events = []
+        self.frames = 0
+        self.game_over = False
+        # Image indexes of the snapshots sent to spectators
+        self.net_images = {tuple(name.split('/')): index
+                           for index, (name, number, _)
+                           in enumerate(net_image_table())
+                           if number is None}
+
+    def step(self):
+        """Advance the game by one simulation step.
+
+        In a network game, the input of the step is first swapped with
+        the other player, and once done, the step is sent to spectators.
+
+        Raises:
+            NetError: The connection to the other player is lost, or
+                their game no longer matches this one.
+        """
+        players = self.players
+        enemies = self.enemies
+        bonuses = self.bonuses
+
+        events = get_events()
+        if NETPLAY:
+            inputs = NETPLAY.exchange(events, self.checksum())
+        else:
+            inputs = [events]
+        for player, player_events in zip(players, inputs):
+            if player.get_input(player_events):
+                self.game_over = True
+        PROFILER.lap('input')
+        for player in players:
+            player.update()
+        PROFILER.lap('player')
 
         # Add enemies
-        if len(enemies) < ENEMY_MAX:
-            enemy = Enemy()
+        for _ in range(min(self.enemy_spawn, self.enemy_max - len(enemies))):
+            enemy = ENEMY_POOL.acquire()
             enemies.add(enemy)
-        enemies.update()
+        # Homing enemies head for the first player
+        enemies.update(players[0])
+        PROFILER.lap('enemies')
 
         # bonuses disappear when they float off screen.
         useless = [bonus for bonus in bonuses if bonus.x_pos > BOARD_WIDTH
                    or bonus.x_pos < -bonus.width or bonus.y_pos > BOARD_HEIGHT
                    or bonus.y_pos < -bonus.height]
         for buff in useless:
-            bonuses.remove(buff)
+            BONUS_POOL.release(buff)
         bonuses.update()
+        PROFILER.lap('bonuses')
+
+        # Enemies fire back
+        if self.enemy_weapon:
+            enemy_bullets = self.enemy_bullets
+            enemy_bullets.update()
+            release_offscreen(enemy_bullets, BULLET_POOL)
+            self.enemies_fire()
+            PROFILER.lap('enemy_bullets')
+
+        self.events = self.resolve_hits()
+        for event in self.events:
+            players[event.player].score += event.points
+
+        for player in players:
+            if player.lives <= 0:
+                if ARGS.infinite:
+                    player.lives = 1
+                else:
+                    self.game_over = True
+
+        if self.background.scroll():
+            self.background_moved = True
+        self.frames += 1
+        if ARGS.frames and self.frames >= ARGS.frames:
+            self.game_over = True
+        if REPLAYER and REPLAYER.finished:
+            self.game_over = True
+        if NETPLAY:
+            NETPLAY.poll()
+            if NETPLAY.spectators:
+                NETPLAY.publish(self.frames, [(player.score, player.lives)
+                                              for player in players],
+                                self.snapshot())
+            PROFILER.lap('publish')
+
+    def resolve_hits(self):
+        """Find the contacts of the step, then apply them all at once.
+
+        Contacts are looked for in a fixed order: enemy bullets and
+        enemies hitting the players, bullets hitting enemies, the
+        players picking bonuses up, and bullets hitting bonuses, each
+        player in turn.  Whatever one contact destroys takes no part in
+        the later ones, and is only released, in bulk, at the end.  With
+        --pixel-perfect, the rectangle contacts are narrowed down to
+        those whose opaque pixels overlap.
 
-        # Check if player crashed into an enemy (enemy is always destroyed)
-        if not player.invulnerability:
-            collisions = pygame.sprite.spritecollide(player, enemies, True)
-            for collision in collisions:
-                player.score -= collision.points
-                player.weapons[player.weapon] -= 1
-                if player.weapons[player.weapon] < 1:
-                    player.weapons.pop(player.weapon, None)
-                    player.weapon_index = 0
-                if not player.weapons:
-                    player.lives -= 1
-                    player.reset(weapons=True)
-                player.equip()
-
-        # player shoots an enemy
-        hits = pygame.sprite.groupcollide(enemies, player.bullets,
-                                          False, False)
-        bits = []
-        for enemy in hits:
-            damage = 0
-            for bit in hits[enemy]:
-                damage += bit.strength
-                if bit not in bits:
-                    bits.append(bit)
-            enemy.strength -= damage
-            if enemy.strength < 1:
-                player.score += enemy.points
-                if enemy.bonuses:
-                    name = random.choice(enemy.bonuses)
-                    bonus = Bonus(name, x_pos=enemy.x_pos, y_pos=enemy.y_pos)
-                    bonuses.add(bonus)
-                enemies.remove(enemy)
-        # bullet is not always destroyed
-        for bit in bits:  # some bullets are stronger than others...
-            bit.strength -= 1
-            if bit.strength < 1:
-                player.bullets.remove(bit)
-
-        # player touches a bonus
-        buffs = pygame.sprite.spritecollide(player, bonuses, True)
-        for buff in buffs:
-            player.score += buff.points
-            player.lives += buff.lives
-            if buff.weapon:
-                if buff.weapon not in player.weapons:
-                    player.weapons[buff.weapon] = 1
-                elif player.weapons[buff.weapon] < 8:
-                    player.weapons[buff.weapon] += 1
-
-        # Player shoots a bonus
-        hits = pygame.sprite.groupcollide(player.bullets, bonuses,
-                                          False, False)
-        bits = []
-        for bullet in hits:
-            if bullet.name != 'safety':  # safety bullets do not kill bonuses
-                bullet.strength -= 1
-                for bit in hits[bullet]:
-                    if bit not in bits:
-                        bits.append(bit)
-            if bullet.strength < 1:
-                player.bullets.remove(bullet)
-        for bonus in bits:
-            bonuses.remove(bonus)
-            player.score += bonus.points // 2  # player still get half points
-
-        if player.lives <= 0:
-            if ARGS.infinite:
-                player.lives = 1
+        Returns:
+            List of GameEvent, in the order they happened.
+        """
+        players = self.players
+        enemies = self.enemies
+        bonuses = self.bonuses
+        bonus_grid = self.bonus_grid
+        pixel_perfect = ARGS.pixel_perfect
+        events = []
+        # What the contacts destroy, as dictionaries used as ordered sets
+        dead_enemies = {}
+        spent_bullets = [{} for _ in players]  # By the player who fired
+        gone_bonuses = {}
+
+        # Players are hit by enemy bullets, or crash into enemies (the
+        # enemy is always destroyed)
+        self.enemy_grid.rebuild(enemies)
+        for number, player in enumerate(players):
+            if player.invulnerability:
+                continue
+            if self.enemy_weapon:
+                shots = pygame.sprite.spritecollide(
+                    player, self.enemy_bullets, False)
+                if pixel_perfect:
+                    shots = pixel_collide(player, shots)
+                for bullet in shots:
+                    player.hit()
+                    events.append(GameEvent('hit', bullet.spec.name,
+                                            bullet.x_pos, bullet.y_pos, 0,
+                                            number))
+                BULLET_POOL.release_all(shots, self.enemy_bullets)
+            if not player.invulnerability:
+                crashes = self.enemy_grid.spritecollide(player)
+                if pixel_perfect:
+                    crashes = pixel_collide(player, crashes)
+                for enemy in crashes:
+                    if enemy in dead_enemies:
+                        continue
+                    dead_enemies[enemy] = True
+                    player.hit()
+                    events.append(GameEvent('crash', enemy.spec.name,
+                                            enemy.x_pos, enemy.y_pos,
+                                            -enemy.points, number))
+        PROFILER.lap('collide_player')
+
+        # Players shoot an enemy
+        for number, player in enumerate(players):
+            if ARGS.engine == 'numpy':
+                hits = player.bullets.groupcollide(enemies)
             else:
-                game_over = True
+                self.bullet_grid.rebuild(player.bullets)
+                hits = self.bullet_grid.groupcollide(enemies)
+            if pixel_perfect:
+                hits = pixel_hits(hits)
+            struck = {}  # Bullets that hit an enemy
+            for enemy, bits in hits.items():
+                if enemy in dead_enemies:
+                    continue
+                for bit in bits:
+                    enemy.strength -= bit.strength
+                    struck[bit] = True
+                if enemy.strength < 1:
+                    dead_enemies[enemy] = True
+                    events.append(GameEvent('kill', enemy.spec.name,
+                                            enemy.x_pos, enemy.y_pos,
+                                            enemy.points, number))
+                    if enemy.bonuses:
+                        spec = random.choice(enemy.bonuses)
+                        bonus = BONUS_POOL.acquire(spec, x_pos=enemy.x_pos,
+                                                   y_pos=enemy.y_pos)
+                        bonuses.add(bonus)
+                        events.append(GameEvent('drop', spec.name,
+                                                enemy.x_pos, enemy.y_pos, 0,
+                                                number))
+            # Bullet is not always destroyed; some are stronger than others
+            for bit in struck:
+                bit.strength -= 1
+                if bit.strength < 1:
+                    spent_bullets[number][bit] = True
+        PROFILER.lap('collide_bullets')
+
+        # Players touch a bonus
+        bonus_grid.rebuild(bonuses)
+        for number, player in enumerate(players):
+            buffs = bonus_grid.spritecollide(player)
+            if pixel_perfect:
+                buffs = pixel_collide(player, buffs)
+            for buff in buffs:
+                bonus_grid.remove(buff)
+                gone_bonuses[buff] = True
+                player.lives += buff.lives
+                if buff.weapon:
+                    if buff.weapon not in player.weapons:
+                        player.weapons[buff.weapon] = 1
+                    elif player.weapons[buff.weapon] < 8:
+                        player.weapons[buff.weapon] += 1
+                events.append(GameEvent('pickup', buff.spec.name, buff.x_pos,
+                                        buff.y_pos, buff.points, number))
+        PROFILER.lap('collide_pickups')
+
+        # Players shoot a bonus (player still gets half points)
+        for number, player in enumerate(players):
+            spent = spent_bullets[number]
+            shot = {}
+            hits = bonus_grid.groupcollide(player.bullets)
+            if pixel_perfect:
+                hits = pixel_hits(hits)
+            for bullet, bits in hits.items():
+                if bullet in spent:
+                    continue
+                if bullet.spec.kills_bonuses:
+                    bullet.strength -= 1
+                    shot.update(dict.fromkeys(bits, True))
+                if bullet.strength < 1:
+                    spent[bullet] = True
+            for bonus in shot:
+                bonus_grid.remove(bonus)
+                gone_bonuses[bonus] = True
+                events.append(GameEvent('shoot_bonus', bonus.spec.name,
+                                        bonus.x_pos, bonus.y_pos,
+                                        bonus.points // 2, number))
+            BULLET_POOL.release_all(spent, player.bullets)
+
+        ENEMY_POOL.release_all(dead_enemies, enemies)
+        BONUS_POOL.release_all(gone_bonuses, bonuses)
+        PROFILER.lap('collide_bonuses')
+        return events
+
+    def enemies_fire(self):
+        """Have a share of the enemies on the board fire at the players.
+
+        Every enemy fires once per STRESS_FIRE_INTERVAL steps, in turns
+        by group order, so the same enemies fire whatever the engine.
+        With more than one player, the enemies that fire take turns
+        aiming at each.
+        """
+        players = self.players
+        spec = self.enemy_weapon
+        targets = [(player.x_pos + player.width // 2,
+                    player.y_pos + player.height // 2) for player in players]
+        turn = self.frames % STRESS_FIRE_INTERVAL
+        shooters = (enemy for enemy
+                    in self.enemies.sprites()[turn::STRESS_FIRE_INTERVAL]
+                    if 0 <= enemy.x_pos < BOARD_WIDTH)
+        for index, enemy in enumerate(shooters):
+            target_x, target_y = targets[index % len(targets)]
+            x_dist = target_x - enemy.x_pos
+            y_dist = target_y - enemy.y_pos
+            scale = spec.speed / (math.hypot(x_dist, y_dist) or 1)
+            bullet = BULLET_POOL.acquire(
+                spec, enemy.x_pos, enemy.y_pos,
+                x_inc=round(x_dist * scale) or -spec.speed,
+                y_inc=round(y_dist * scale))
+            self.enemy_bullets.add(bullet)
+
+    def draw(self, alpha=None):
+        """Draw the game on the board.
+
+        Args:
+            alpha: Fraction of a step to move sprites on from their
+                previous position towards the current one; None draws
+                them at the current position.
+        """
+        players = self.players
+        if RENDERER:
+            RENDERER.clear(self.background, self.background_moved)
+            PROFILER.lap('background')
+        else:
+            BOARD.fill((10, 0, 15))
+            PROFILER.lap('fill')
+            # blit the backdrops first
+            self.background.draw(BOARD)
+            PROFILER.lap('background')
+        self.background_moved = False
+        for line, player in enumerate(players):
+            show_stats(player.lives, player.score, player.weapons.keys(),
+                       line)
+        PROFILER.lap('stats')
+        draw_sprites([players] + [player.bullets for player in players]
+                     + [self.enemies, self.bonuses, self.enemy_bullets],
+                     alpha)
+        PROFILER.lap('sprites')
+
+    def checksum(self):
+        """Get a checksum of the game state.
+
+        Two games that started the same and got the same input have the
+        same checksum; games that drifted apart almost surely not.
+
+        Returns:
+            Checksum, as a 32-bit integer.
+        """
+        state = [self.frames, random.getstate()[1], len(self.enemies),
+                 len(self.bonuses), len(self.enemy_bullets)]
+        for player in self.players:
+            state.extend((player.x_pos, player.y_pos, player.lives,
+                          player.score, len(player.bullets)))
+        return zlib.crc32(repr(state).encode())
+
+    def snapshot(self):
+        """List the entities on the board, for spectators.
+
+        Returns:
+            List of (sprite, image index, x, y) tuples, as for
+            netplay.SnapshotEncoder.encode(), with the image indexes of
+            net_image_table().
+        """
+        images = self.net_images
+        entities = [(player, player.number * 2
+                     + (player.image is player.image_alt),
+                     player.x_pos, player.y_pos) for player in self.players]
+        groups = [player.bullets for player in self.players]
+        groups.extend((self.bonuses, self.enemy_bullets))
+        for group in groups:
+            entities.extend([
+                (sprite, images[sprite.kind, sprite.name], sprite.x_pos,
+                 sprite.y_pos) for sprite in group])
+        # Enemies waiting off the right side are no use to show
+        entities.extend([
+            (enemy, images['enemy', enemy.name], enemy.x_pos, enemy.y_pos)
+            for enemy in self.enemies if enemy.x_pos < BOARD_WIDTH])
+        return entities
+
+
+class SpectatorView():
+    """A game hosted elsewhere, as told by the snapshots it sends.
+
+    It stands in for Game in the main loop: step() takes in the
+    snapshots that came since the last frame, and draw() shows the
+    latest.
+    """
+    def __init__(self):
+        """Initialize the view, with the image table of the host.
+        """
+        self.background = Background(('far', 'near'), x_inc=-2, y_inc=-1,
+                                     interval=ARGS.scroll_interval)
+        self.background_moved = True
+        self.images = []
+        for name, number, blinking in SPECTATOR.images:
+            if number is None:
+                image = IMAGES.get(name)
+            else:
+                image = player_images(name.partition('/')[2],
+                                      number)[blinking]
+            self.images.append(image)
+        self.host_step = 0
+        self.frames = 0
+        self.game_over = False
 
-        CLOCK.tick(FRAME_RATE)
-        pygame.display.flip()
+    def step(self):
+        """Take in the snapshots that came since the last frame.
 
+        Waits a little for one if none came yet.
+        """
+        for event in pygame.event.get():
+            if event.type == pygame.QUIT:
+                self.game_over = True
+            elif event.type == pygame.KEYDOWN:
+                if event.key == pygame.K_ESCAPE:
+                    self.game_over = True
+                elif event.key == pygame.K_F3:
+                    PROFILER.overlay = not PROFILER.overlay
+        PROFILER.lap('input')
+        try:
+            if SPECTATOR.receive(SPECTATE_WAIT):
+                while SPECTATOR.receive(0):
+                    pass
+        except NetError:  # The game is over, or the host gone
+            self.game_over = True
+        # The backgrounds scroll along with the host steps, from its first
+        for _ in range(SPECTATOR.decoder.step - self.host_step):
+            if self.background.scroll():
+                self.background_moved = True
+        self.host_step = SPECTATOR.decoder.step
+        self.frames += 1
+        if ARGS.frames and self.frames >= ARGS.frames:
+            self.game_over = True
+
+    def draw(self, alpha=None):
+        """Draw the latest snapshot on the board.
+
+        Args:
+            alpha: Ignored; snapshots are drawn as they are.
+        """
+        if RENDERER:
+            RENDERER.clear(self.background, self.background_moved)
+            PROFILER.lap('background')
+        else:
+            BOARD.fill((10, 0, 15))
+            PROFILER.lap('fill')
+            self.background.draw(BOARD)
+            PROFILER.lap('background')
+        self.background_moved = False
+        decoder = SPECTATOR.decoder
+        for line, (score, lives) in enumerate(decoder.stats):
+            show_stats(lives, score, None, line)
+        PROFILER.lap('stats')
+        images = self.images
+        batch = [(images[image], (x_pos, y_pos))
+                 for image, x_pos, y_pos in decoder.entities.values()]
+        if RENDERER:
+            for rect in BOARD.blits(batch):
+                RENDERER.mark(rect)
+        else:
+            BOARD.blits(batch, False)
+        PROFILER.lap('sprites')
+
+
+def main():
+    """The game itself.
+    """
+    exit_code = 0
+    if SPECTATOR:
+        game = SpectatorView()
+    else:
+        game = Game(NET_PLAYERS if NETPLAY else 1)
+
+    start_time = time.perf_counter()
+    last_time = start_time
+    lag = 0.0
+    while not game.game_over:
+        PROFILER.start()
+        if ARGS.fixed_step and not ARGS.headless:
+            # Run as many steps as the time since the last frame calls
+            # for, but give up on catching up beyond max_steps.
+            now = time.perf_counter()
+            lag += now - last_time
+            last_time = now
+            steps = 0
+            while (lag >= STEP_TIME and steps < ARGS.max_steps
+                   and not game.game_over):
+                game.step()
+                lag -= STEP_TIME
+                steps += 1
+            if lag >= STEP_TIME:
+                lag %= STEP_TIME
+            game.draw(lag / STEP_TIME)
+        else:
+            game.step()
+            game.draw()
+
+        PROFILER.draw()
+        PROFILER.lap('overlay')
+        if CAPTURE:
+            CAPTURE.capture(BOARD)
+            PROFILER.lap('capture')
+        if not ARGS.headless:
+            CLOCK.tick(FRAME_RATE)
+            PROFILER.lap('tick')
+        if RENDERER:
+            RENDERER.present(show=not ARGS.headless)
+            PROFILER.lap('flip')
+        elif not ARGS.headless:
+            pygame.display.flip()
+            PROFILER.lap('flip')
+        PROFILER.stop()
+
+    if ARGS.headless:
+        elapsed = time.perf_counter() - start_time
+        print('%d frames in %.3f s (%.1f FPS)'
+              % (game.frames, elapsed,
+                 game.frames / elapsed if elapsed else 0.0))
+        for pool in (BULLET_POOL, ENEMY_POOL, BONUS_POOL):
+            print('%s pool: %d hits, %d misses'
+                  % (pool.sprite_class.__name__, pool.hits, pool.misses))
     return exit_code
 
 
-if __name__ == '__main__':
-    ARGS = parse_args()
+def setup(args):
+    """Set up the globals the game runs on, for the given arguments.
+
+    Args:
+        args: Arguments, as from parse_args().
+
+    Raises:
+        OSError: The recording or the capture could not be read or
+            written, or the network game could not be set up.
+        ValueError: The recording or the content pack is not valid.
+    """
+    global ARGS, RECORDER, REPLAYER, CONTENT, BOARD, CLOCK, GAME_FONT
+    global STATS_TEXT, TEXT_CACHE, IMAGES, PROFILER, RENDERER, BULLET_POOL
+    global CAPTURE, NETPLAY, SPECTATOR
+    ARGS = args
+    if args.headless:
+        os.environ['SDL_VIDEODRIVER'] = 'dummy'
+    RECORDER = REPLAYER = NETPLAY = SPECTATOR = None
+    if args.replay:
+        REPLAYER = InputReplayer(args.replay)
+        args.seed = REPLAYER.seed
+    elif args.record:
+        if args.seed is None:
+            args.seed = random.randrange(SEED_MAX)
+        RECORDER = InputRecorder(args.record, args.seed)
+    CONTENT = Content(ENEMIES, BONUSES, WEAPONS)
+    if args.content:
+        try:
+            CONTENT = Content.load(args.content)
+        except (OSError, ValueError) as error:
+            raise ContentError('%s: %s' % (args.content, error))
+    if args.stress:
+        CONTENT = CONTENT.with_count_max(STRESS_COUNT_MAX)
+    if args.host is not None:
+        if args.seed is None:
+            args.seed = random.randrange(SEED_MAX)
+        NETPLAY = host(args.host, args.seed, net_rules(args),
+                       net_image_table())
+    elif args.join:
+        NETPLAY = join(args.join, net_rules(args))
+        args.seed = NETPLAY.seed
+    elif args.spectate:
+        SPECTATOR = Spectator(args.spectate)
+    random.seed(args.seed)
     pygame.init()
     BOARD = pygame.display.set_mode(BOARD_SIZE)
+    CAPTURE = (FrameCapture(args.capture, BOARD, args.capture_frames)
+               if args.capture else None)
     CLOCK = pygame.time.Clock()
     GAME_FONT = pygame.font.Font(None, 20)
-    IMAGES = ImageStore(os.path.join(sys.path[0], IMAGE_PATH), 'png')
+    STATS_TEXT = TextCache(GAME_FONT)
+    TEXT_CACHE = TextCache(GAME_FONT)
+    base_path = os.path.dirname(os.path.abspath(__file__))
+    IMAGES = AtlasStore(
+        os.path.join(base_path, IMAGE_PATH), 'png',
+        cache_path=(None if args.no_image_cache
+                    else default_cache_path(__file__)))
+    load_times = IMAGES.preload()
+    missing = CONTENT.image_names().difference(IMAGES.names())
+    if missing:
+        raise ContentError('%s: no image for %s'
+                           % (args.content, ', '.join(sorted(missing))))
+    if SPECTATOR:
+        missing = {name for name, _, _ in SPECTATOR.images}.difference(
+            IMAGES.names())
+        if missing:
+            raise ContentError('the host shows images not found here: %s'
+                               % ', '.join(sorted(missing)))
+    if args.load_times:
+        for name, load_time in sorted(load_times.items()):
+            print('%-20s %7.2f ms' % (name, load_time * 1000))
+    if args.atlas:
+        IMAGES.build_atlas()
+    PROFILER = FrameProfiler()
+    RENDERER = DirtyRenderer() if args.dirty else None
+    BULLET_POOL = SpritePool(BulletEntity if args.engine == 'slots'
+                             else Bullet)
 
-    EXIT_CODE = main()
-    show_text('Good-bye!', 2)
+
+if __name__ == '__main__':
+    ARGS = parse_args()
+    if ARGS.bench_startup:
+        bench_startup()
+        sys.exit(0)
+    try:
+        setup(ARGS)
+    except (OSError, ValueError) as error:
+        sys.exit(error)
+
+    try:
+        EXIT_CODE = main()
+    except NetError as error:
+        print(error)
+        EXIT_CODE = 1
+    if RECORDER:
+        RECORDER.close()
+    if NETPLAY:
+        NETPLAY.close()
+    if SPECTATOR:
+        SPECTATOR.close()
+    if CAPTURE:
+        CAPTURE.close()
+    if ARGS.profile:
+        PROFILER.dump(ARGS.profile)
+    if not ARGS.headless:
+        show_text('Good-bye!', 2)
     pygame.quit()
     sys.exit(EXIT_CODE)
@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+"""Gym-style environment around jatype, for training agents.
+
+Every step() runs exactly one simulation step of the game, headless and
+without the frame rate cap.  Observations are either the board pixels,
+as a pygame.surfarray.pixels3d() view of the board that copies nothing,
+or a small array of entity positions.
+
+A pixels3d() view locks its surface for as long as it exists, and a
+locked surface cannot be drawn on, so the environment draws the steps
+on two boards in turn.  The pixels of a step stay valid through the
+next step, which draws on the other board, but not the one after:
+copy observations that need to be kept longer.  A step fails with
+RuntimeError while the board it would draw on is still held.
+"""
+import argparse
+import itertools
+import os
+import random
+import sys
+import time
+
+os.environ.setdefault('PYGAME_HIDE_SUPPORT_PROMPT', '1')
+import numpy
+import pygame
+
+import jatype
+from batch import Policy
+
+
+OBSERVATIONS = ('pixels', 'entities')
+ENTITY_ROWS = 64  # Rows of the entity observation; the rest are left out
+(KIND_PLAYER, KIND_ENEMY, KIND_BONUS, KIND_BULLET,
+ KIND_ENEMY_BULLET) = range(1, 6)
+# Every combination of vertical move, horizontal move and firing
+ACTIONS = tuple(itertools.product(
+    (None, pygame.K_UP, pygame.K_DOWN),
+    (None, pygame.K_LEFT, pygame.K_RIGHT),
+    (False, True)))
+BENCH_STEPS = 10000
+
+
+class ActionInput(Policy):
+    """Turns the action of every step into input events.
+    """
+    def __init__(self):
+        """Initialize the input, with no keys held.
+        """
+        super(ActionInput, self).__init__(None)
+        self.action = ACTIONS[0]
+
+    def decide(self, game):
+        vertical, horizontal, fire = self.action
+        events = (self.hold('vertical', vertical)
+                  + self.hold('horizontal', horizontal))
+        if fire:
+            events.extend(self.press(pygame.K_SPACE))
+        return events
+
+
+class JatypeEnv(object):
+    """jatype with reset(), step() and render(), like a Gym environment.
+    Actions are indexes into ACTIONS.  The reward of a step is how much
+    the score changed.
+    """
+    def __init__(self, observation='pixels', frames=jatype.HEADLESS_FRAMES,
+                 game_args=()):
+        """Set the game up.
+        Args:
+            observation: 'pixels' for the board pixels, as an array of
+                width x height x RGB, or 'entities' for an array of
+                ENTITY_ROWS rows of kind, x and y, one per entity.
+            frames: Most frames per episode.
+            game_args: More jatype arguments, such as ['-e', 'numpy'].
+        Raises:
+            ValueError: The observation type is unknown, or the game
+                arguments ask for dirty rectangle rendering, which needs
+                the previous frame on the board.
+        """
+        if observation not in OBSERVATIONS:
+            raise ValueError('unknown observation type %r' % observation)
+        jatype.setup(jatype.parse_args(
+            ['--headless', '--frames', str(frames)] + list(game_args)))
+        if jatype.RENDERER:
+            raise ValueError('dirty rectangle rendering is not supported')
+        self.observation = observation
+        self.action_count = len(ACTIONS)
+        self.game = None
+        self._input = None
+        self._score = 0
+        self._pixels = None
+        self._drawn = False
+        self._boards = [jatype.BOARD, jatype.BOARD.copy()]
+        self._current = 0  # Index of the board drawn last
+        self._entities = numpy.zeros((ENTITY_ROWS, 3), numpy.int32)
+
+    def reset(self, seed=None):
+        """Start a new episode.
+        Args:
+            seed: Random seed of the episode; None for a random one.
+        Returns:
+            First observation.
+        Raises:
+            RuntimeError: Observations still lock both boards.
+        """
+        jatype.BOARD = self._free_board()  # Setting the game up draws
+        random.seed(seed)
+        self._input = ActionInput()
+        jatype.REPLAYER = self._input
+        self.game = self._input.game = jatype.Game()
+        self._score = 0
+        self._drawn = False
+        return self._observe()
+
+    def step(self, action):
+        """Run one simulation step.
+        Args:
+            action: Index into ACTIONS.
+        Returns:
+            Tuple: (observation, reward, done, info), where info holds
+                the score, lives and frames, whether the episode was cut
+                short by the frame limit, and the GameEvents of the step.
+        Raises:
+            RuntimeError: The episode is over, or an observation of an
+                earlier step still locks the board to draw on.
+        """
+        game = self.game
+        if game is None or game.game_over:
+            raise RuntimeError('the episode is over; call reset()')
+        if self.observation == 'pixels':
+            self._free_board()
+        self._input.action = ACTIONS[action]
+        game.step()
+        self._drawn = False
+        player = game.player
+        reward = player.score - self._score
+        self._score = player.score
+        info = {
+            'score': player.score,
+            'lives': player.lives,
+            'frames': game.frames,
+            'truncated': game.game_over and game.frames >= jatype.ARGS.frames,
+            'events': game.events,
+            }
+        return self._observe(), reward, game.game_over, info
+
+    def render(self):
+        """Get the board as drawn for the current step.
+        Returns:
+            pixels3d() view of the board, valid through the next step.
+        """
+        self._draw()
+        return self._pixels
+
+    def close(self):
+        """Shut the game down.
+        """
+        self._pixels = None
+        self._boards = []
+        pygame.quit()
+
+    def _free_board(self):
+        """Get the board to draw the next step on.
+        Returns:
+            Board surface.
+        Raises:
+            RuntimeError: An observation still locks the board.
+        """
+        board = self._boards[1 - self._current]
+        if board.get_locked():
+            raise RuntimeError('an observation of an earlier step still '
+                               'locks the board; copy observations that '
+                               'are kept for more than one step')
+        return board
+
+    def _draw(self):
+        """Draw the current step, unless already drawn.
+        """
+        if not self._drawn:
+            jatype.BOARD = board = self._free_board()
+            self.game.draw()
+            self._current = 1 - self._current
+            self._pixels = pygame.surfarray.pixels3d(board)
+            self._drawn = True
+
+    def _observe(self):
+        """Get the observation of the current step.
+        Returns:
+            Observation array, valid through the next step for pixels
+            and until the next step for entities.
+        """
+        if self.observation == 'pixels':
+            self._draw()
+            return self._pixels
+        game = self.game
+        player = game.player
+        rows = [(KIND_PLAYER, player.x_pos, player.y_pos)]
+        for kind, group in ((KIND_ENEMY, game.enemies),
+                            (KIND_BONUS, game.bonuses),
+                            (KIND_BULLET, player.bullets),
+                            (KIND_ENEMY_BULLET, game.enemy_bullets)):
+            rows.extend([(kind, sprite.x_pos, sprite.y_pos)
+                         for sprite in group])
+        rows = rows[:ENTITY_ROWS]
+        entities = self._entities
+        entities[:len(rows)] = rows
+        entities[len(rows):] = 0
+        return entities
+
+
+def main():
+    """Time random play, to check how many steps per second to expect.
+    """
+    parser = argparse.ArgumentParser(
+            description='Time the environment with random actions. '
+            'Unknown options are passed on to the game.')
+    parser.add_argument('-o', '--observation', choices=OBSERVATIONS,
+            default=OBSERVATIONS[0], help='Observation type.')
+    parser.add_argument('-n', '--steps', type=int, default=BENCH_STEPS,
+            help='Steps to time (default: %d).' % BENCH_STEPS)
+    args, game_args = parser.parse_known_args()
+    env = JatypeEnv(args.observation, game_args=game_args)
+    actions = random.Random(0)
+    env.reset(0)
+    episodes = 1
+    start_time = time.perf_counter()
+    for _ in range(args.steps):
+        _, _, done, _ = env.step(actions.randrange(env.action_count))
+        if done:
+            env.reset(episodes)
+            episodes += 1
+    elapsed = time.perf_counter() - start_time
+    print('%d steps in %.2f s (%.0f steps/s), %d episodes'
+          % (args.steps, elapsed, args.steps / elapsed, episodes))
+    env.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,640 @@
+"""Two-player lockstep games and spectating over TCP, for jatype.
+
+Both players run the whole game.  In every step, each sends the other
+the input events it took and waits for those of the other, so both
+games step with the same input and, started from the same seed and
+options, stay the same.  Each input message carries a checksum of the
+game state, so games that drift apart are caught at once.
+
+The host also streams the game to spectators, as snapshots of every
+entity.  A snapshot only holds what changed since the one before: small
+moves as 1-byte offsets, entities that appeared or jumped in full, and
+the entities that went away.
+
+Messages are a type (1 byte) and a payload length (4 bytes), then the
+payload.  All numbers are little-endian.
+    HELLO, WELCOME: JSON, once per connection
+    INPUT: step (4 bytes), checksum (4 bytes), then one byte per event:
+        the key index in NET_KEYS, plus KEY_UP for a key release, or
+        QUIT_CODE for quitting
+    SNAPSHOT: step (4 bytes), flags (1 byte), then counts of players,
+        moved, added and removed entities (1, 2, 2 and 2 bytes), then
+        per player: score (4 bytes), lives (1 byte)
+        moved: IDs (2 bytes each), then x and y offsets (1 byte each)
+        added: IDs (2 bytes each), image indexes (2 bytes each), then x
+            and y (2 bytes each)
+        removed: IDs (2 bytes each)
+"""
+import json
+import select
+import socket
+import struct
+import time
+
+import pygame
+
+
+VERSION = 1
+DEFAULT_PORT = 7431
+MESSAGE = struct.Struct('<BI')
+INPUT = struct.Struct('<II')
+SNAPSHOT = struct.Struct('<IBBHHH')
+PLAYER_STATS = struct.Struct('<iB')
+MSG_HELLO, MSG_WELCOME, MSG_INPUT, MSG_SNAPSHOT = range(4)
+KEYFRAME = 1  # Snapshot flag: forget all entities first
+ENTITY_MAX = 0x10000  # IDs are 2 bytes
+IMAGE_MAX = 0x10000  # Image indexes are 2 bytes
+MOVE_MAX = 127  # Largest offset sent as a move, in pixels
+HELLO_TIMEOUT = 2.0  # Seconds a new connection has to say hello
+HELLO_MAX = 0x10000  # Largest hello, in bytes
+SEND_TIMEOUT = 1.0  # Seconds a spectator may hold the game up
+
+# Every key that changes the game state in jatype's Player.get_input();
+# others, such as pause, only matter to the player pressing them
+NET_KEYS = (pygame.K_ESCAPE, pygame.K_x, pygame.K_z, pygame.K_c,
+            pygame.K_UP, pygame.K_DOWN, pygame.K_LEFT, pygame.K_RIGHT,
+            pygame.K_SPACE, pygame.K_1)
+KEY_UP = 0x80
+QUIT_CODE = 0x7F
+
+
+class NetError(ConnectionError):
+    """Connection lost, or the other side does not play the same game.
+    """
+
+
+def parse_address(text, default_host='localhost'):
+    """Parse an address such as "example.org:7431", "example.org" or
+    "7431".
+    Args:
+        text: Host, port, or both separated by a colon.
+        default_host: Host if none is given.
+    Returns:
+        Tuple: (host, port)
+    Raises:
+        ValueError: The port is not a number.
+    """
+    host, _, port = str(text).rpartition(':')
+    if not host and not port.isdigit():
+        host, port = port, ''
+    return host or default_host, int(port) if port else DEFAULT_PORT
+
+
+def encode_events(events):
+    """Encode the input events that change the game.
+    Args:
+        events: Events of one step.
+    Returns:
+        Bytes, one per event.
+    """
+    codes = bytearray()
+    for event in events:
+        if event.type == pygame.QUIT:
+            codes.append(QUIT_CODE)
+        elif (event.type in (pygame.KEYDOWN, pygame.KEYUP)
+              and event.key in NET_KEYS):
+            code = NET_KEYS.index(event.key)
+            if event.type == pygame.KEYUP:
+                code |= KEY_UP
+            codes.append(code)
+    return bytes(codes)
+
+
+def decode_events(codes):
+    """Decode input events.
+    Args:
+        codes: Bytes from encode_events().
+    Returns:
+        List of events.
+    """
+    events = []
+    for code in codes:
+        if code == QUIT_CODE:
+            events.append(pygame.event.Event(pygame.QUIT))
+        else:
+            event_type = pygame.KEYUP if code & KEY_UP else pygame.KEYDOWN
+            events.append(pygame.event.Event(
+                event_type, key=NET_KEYS[code & ~KEY_UP]))
+    return events
+
+
+class Connection(object):
+    """Message stream over a TCP socket.
+    """
+    def __init__(self, sock):
+        """Wrap a connected socket.
+        Args:
+            sock: Socket.
+        """
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock = sock
+
+    def send(self, message_type, payload):
+        """Send a message.
+        Args:
+            message_type: One of the MSG_ constants.
+            payload: Bytes to send.
+        Raises:
+            NetError: The connection is lost.
+        """
+        try:
+            self.sock.sendall(MESSAGE.pack(message_type, len(payload))
+                              + payload)
+        except OSError as error:
+            raise NetError('connection lost: %s' % error)
+
+    def receive(self, expected):
+        """Wait for a message.
+        Args:
+            expected: Message type to expect.
+        Returns:
+            Payload bytes.
+        Raises:
+            NetError: The connection is lost, or the message is of
+                another type.
+        """
+        message_type, length = MESSAGE.unpack(self._read(MESSAGE.size))
+        if message_type != expected:
+            raise NetError('unexpected message type %d' % message_type)
+        return self._read(length)
+
+    def send_json(self, message_type, value):
+        """Send a message with a JSON payload.
+        """
+        self.send(message_type, json.dumps(value).encode())
+
+    def receive_json(self, expected):
+        """Wait for a message with a JSON payload.
+        """
+        try:
+            return json.loads(self.receive(expected).decode())
+        except ValueError:
+            raise NetError('malformed handshake')
+
+    def close(self):
+        """Close the connection.
+        """
+        self.sock.close()
+
+    def _read(self, size):
+        """Read exactly size bytes.
+        """
+        data = bytearray()
+        while len(data) < size:
+            try:
+                chunk = self.sock.recv(size - len(data))
+            except OSError as error:
+                raise NetError('connection lost: %s' % error)
+            if not chunk:
+                raise NetError('connection closed')
+            data.extend(chunk)
+        return bytes(data)
+
+
+class SnapshotEncoder(object):
+    """Encodes entity snapshots as deltas from the previous one.
+    """
+    def __init__(self):
+        """Initialize the encoder; the first snapshot is a keyframe.
+        """
+        self._ids = {}  # Key to ID
+        self._keys = {}  # ID to key
+        self._free_ids = []
+        self._state = {}
+        self._keyframe = True
+
+    def keyframe(self):
+        """Make the next snapshot a keyframe, for new spectators.
+        """
+        self._keyframe = True
+
+    def encode(self, step, stats, entities):
+        """Encode the changes since the previous snapshot.
+        Args:
+            step: Game step.
+            stats: List of (score, lives) tuples, one per player.
+            entities: Iterable of (key, image index, x, y) tuples, where
+                key is any hashable object that stays the same for an
+                entity, such as the sprite itself.
+        Returns:
+            Snapshot payload bytes.
+        Raises:
+            NetError: There are more entities than snapshots can tell apart.
+        """
+        ids = self._ids
+        previous = {} if self._keyframe else self._state
+        state = {}
+        moved_ids, moves = [], []
+        added_ids, images, positions = [], [], []
+        for key, image, x_pos, y_pos in entities:
+            entity_id = ids.get(key)
+            if entity_id is None:
+                entity_id = ids[key] = self._new_id()
+                self._keys[entity_id] = key
+            entry = state[entity_id] = (image, x_pos, y_pos)
+            old = previous.get(entity_id)
+            if old == entry:
+                continue
+            if (old is not None and old[0] == image
+                    and abs(x_pos - old[1]) <= MOVE_MAX
+                    and abs(y_pos - old[2]) <= MOVE_MAX):
+                moved_ids.append(entity_id)
+                moves.extend((x_pos - old[1], y_pos - old[2]))
+            else:
+                added_ids.append(entity_id)
+                images.append(image)
+                positions.extend((x_pos, y_pos))
+        removed_ids = [entity_id for entity_id in previous
+                       if entity_id not in state]
+        # Only reused from the next snapshot on, since the decoder applies
+        # the removals after the additions
+        for entity_id in self._state:
+            if entity_id not in state:
+                del ids[self._keys.pop(entity_id)]
+                self._free_ids.append(entity_id)
+        flags = KEYFRAME if self._keyframe else 0
+        self._state = state
+        self._keyframe = False
+        return b''.join([
+            SNAPSHOT.pack(step, flags, len(stats), len(moved_ids),
+                          len(added_ids), len(removed_ids)),
+            b''.join([PLAYER_STATS.pack(score, max(0, min(lives, 255)))
+                      for score, lives in stats]),
+            struct.pack('<%dH' % len(moved_ids), *moved_ids),
+            struct.pack('<%db' % len(moves), *moves),
+            struct.pack('<%dH' % len(added_ids), *added_ids),
+            struct.pack('<%dH' % len(images), *images),
+            struct.pack('<%dh' % len(positions), *positions),
+            struct.pack('<%dH' % len(removed_ids), *removed_ids),
+            ])
+
+    def _new_id(self):
+        """Get an ID no entity has.
+        Raises:
+            NetError: All IDs are taken.
+        """
+        if self._free_ids:
+            return self._free_ids.pop()
+        if len(self._keys) >= ENTITY_MAX:
+            raise NetError('too many entities to show spectators: at most '
+                           '%d' % ENTITY_MAX)
+        return len(self._keys)
+
+
+class SnapshotDecoder(object):
+    """Rebuilds the entities from a stream of snapshots.
+    """
+    def __init__(self):
+        """Initialize the decoder, with no entities.
+        """
+        self.step = 0
+        self.stats = []
+        self.entities = {}  # ID to [image index, x, y]
+
+    def decode(self, payload):
+        """Apply a snapshot.
+        Args:
+            payload: Snapshot payload bytes.
+        Raises:
+            NetError: The snapshot is malformed.
+        """
+        try:
+            self._decode(payload)
+        except (struct.error, KeyError):
+            raise NetError('malformed snapshot')
+
+    def _decode(self, payload):
+        (self.step, flags, players, moved, added,
+         removed) = SNAPSHOT.unpack_from(payload)
+        offset = SNAPSHOT.size
+        entities = self.entities
+        if flags & KEYFRAME:
+            entities.clear()
+        self.stats = []
+        for _ in range(players):
+            self.stats.append(PLAYER_STATS.unpack_from(payload, offset))
+            offset += PLAYER_STATS.size
+
+        def column(code, count):
+            nonlocal offset
+            values = struct.unpack_from('<%d%s' % (count, code), payload,
+                                        offset)
+            offset += struct.calcsize('<%d%s' % (count, code))
+            return values
+
+        moved_ids = column('H', moved)
+        moves = column('b', moved * 2)
+        for index, entity_id in enumerate(moved_ids):
+            entity = entities[entity_id]
+            entity[1] += moves[index * 2]
+            entity[2] += moves[index * 2 + 1]
+        added_ids = column('H', added)
+        images = column('H', added)
+        positions = column('h', added * 2)
+        for index, entity_id in enumerate(added_ids):
+            entities[entity_id] = [images[index], positions[index * 2],
+                                   positions[index * 2 + 1]]
+        for entity_id in column('H', removed):
+            del entities[entity_id]
+
+
+class Lockstep(object):
+    """One player's end of a two-player game.
+    """
+    def __init__(self, connection, number, seed):
+        """Initialize the session.
+        Args:
+            connection: Connection to the other player.
+            number: Index of the local player: 0 hosts, 1 joined.
+            seed: Random seed of the game.
+        """
+        self.number = number
+        self.seed = seed
+        self.step = 0
+        self._peer = connection
+        self._listener = None
+        self._welcome = None
+        self._pending = {}  # Socket to (connection, data, deadline)
+        self._spectators = []
+        self._encoder = SnapshotEncoder()
+
+    @property
+    def spectators(self):
+        """Number of spectators watching.
+        """
+        return len(self._spectators)
+
+    def exchange(self, events, checksum):
+        """Swap the input of this step with the other player.
+        Args:
+            events: Local input events.
+            checksum: Checksum of the local game state.
+        Returns:
+            List of the input events of each player, by player index.
+        Raises:
+            NetError: The connection is lost, or the games differ.
+        """
+        self._peer.send(MSG_INPUT, INPUT.pack(self.step, checksum)
+                        + encode_events(events))
+        payload = self._peer.receive(MSG_INPUT)
+        step, their_checksum = INPUT.unpack_from(payload)
+        if step != self.step:
+            raise NetError('expected step %d, got %d' % (self.step, step))
+        if their_checksum != checksum:
+            raise NetError('games out of step at step %d' % step)
+        theirs = decode_events(payload[INPUT.size:])
+        self.step += 1
+        return [events, theirs] if self.number == 0 else [theirs, events]
+
+    def poll(self, timeout=0):
+        """Serve the connections waiting to be let in, when hosting.
+        New connections are not waited for: their hello is read as it
+        comes in, over as many calls as it takes.  Spectators are
+        welcomed and kept.
+        Args:
+            timeout: Seconds to wait for a connection to do something;
+                None to wait for as long as it takes.
+        Returns:
+            Tuple: (connection, HELLO message) of a player who said
+            hello while there is room for one, or None.
+        """
+        if not self._listener:
+            return None
+        pending = self._pending
+        readable = select.select([self._listener] + list(pending), [], [],
+                                 timeout)[0]
+        player = None
+        for sock in readable:
+            if sock is self._listener:
+                self._accept()
+            elif player is None:
+                player = self._greet(sock)
+        now = time.monotonic()
+        for sock, (connection, _, deadline) in list(pending.items()):
+            if now > deadline:  # Too slow to say hello
+                del pending[sock]
+                connection.close()
+        return player
+
+    def publish(self, step, stats, entities):
+        """Send a snapshot to the spectators, if there are any.
+        Args:
+            step, stats, entities: As for SnapshotEncoder.encode().
+        """
+        if not self._spectators:
+            return
+        payload = self._encoder.encode(step, stats, entities)
+        for spectator in self._spectators[:]:
+            try:
+                spectator.send(MSG_SNAPSHOT, payload)
+            except NetError:
+                spectator.close()
+                self._spectators.remove(spectator)
+
+    def close(self):
+        """Close all connections.
+        """
+        connections = self._spectators + [
+            connection for connection, _, _ in self._pending.values()]
+        if self._peer:
+            connections.append(self._peer)
+        for connection in connections:
+            connection.close()
+        if self._listener:
+            self._listener.close()
+
+    def _accept(self):
+        """Accept a connection on the listening socket, to be greeted.
+        """
+        try:
+            sock, _ = self._listener.accept()
+        except BlockingIOError:  # Gone again already
+            return
+        sock.setblocking(False)
+        self._pending[sock] = (Connection(sock), bytearray(),
+                               time.monotonic() + HELLO_TIMEOUT)
+
+    def _greet(self, sock):
+        """Read what a pending connection sent, and let it in once it
+        said hello.
+        Args:
+            sock: Socket of the connection, ready to read.
+        Returns:
+            Tuple: (connection, HELLO message) of a player, or None.
+        """
+        connection, data, _ = self._pending[sock]
+        try:
+            chunk = sock.recv(HELLO_MAX)
+        except BlockingIOError:
+            return None
+        except OSError:
+            chunk = b''
+        try:
+            if not chunk:
+                raise NetError('connection closed')
+            data.extend(chunk)
+            if len(data) < MESSAGE.size:
+                return None
+            message_type, length = MESSAGE.unpack_from(data)
+            if message_type != MSG_HELLO or length > HELLO_MAX:
+                raise NetError('not a hello')
+            if len(data) < MESSAGE.size + length:
+                return None
+            del self._pending[sock]
+            try:
+                hello = json.loads(bytes(
+                    data[MESSAGE.size:MESSAGE.size + length]).decode())
+            except ValueError:
+                raise NetError('malformed handshake')
+            if not isinstance(hello, dict) or hello.get('version') != VERSION:
+                raise NetError('wrong protocol version')
+            if hello.get('role') == 'player':
+                if self._peer is not None:
+                    raise NetError('the game is full')
+                sock.setblocking(True)
+                return connection, hello
+            # A spectator that cannot keep up is dropped, not waited for
+            sock.settimeout(SEND_TIMEOUT)
+            connection.send_json(MSG_WELCOME, self._welcome)
+        except NetError:
+            self._pending.pop(sock, None)
+            connection.close()
+            return None
+        self._spectators.append(connection)
+        self._encoder.keyframe()
+        return None
+
+
+def _connect(address, hello):
+    """Connect to a host and swap greetings.
+    Args:
+        address: Tuple: (host, port).
+        hello: HELLO message, without the version.
+    Returns:
+        Tuple: (connection, WELCOME message)
+    Raises:
+        NetError: The host could not be reached or did not welcome us.
+    """
+    try:
+        sock = socket.create_connection(address)
+    except OSError as error:
+        raise NetError('cannot connect to %s:%d: %s'
+                       % (address[0], address[1], error))
+    connection = Connection(sock)
+    hello = dict(hello, version=VERSION)
+    connection.send_json(MSG_HELLO, hello)
+    welcome = connection.receive_json(MSG_WELCOME)
+    if not isinstance(welcome, dict) or welcome.get('version') != VERSION:
+        connection.close()
+        raise NetError('the host speaks another protocol version')
+    return connection, welcome
+
+
+def host(port, seed, rules, images):
+    """Host a game, waiting for the second player to join.
+    Spectators may connect while waiting, and at any time after, as
+    long as poll() is called every step.
+    Args:
+        port: TCP port to listen on.
+        seed: Random seed of the game.
+        rules: Dictionary of the options that change the game, which
+            the second player must share.
+        images: Image table of the snapshots, for spectators: a list
+            of JSON values the game can make images of, into which the
+            image indexes of the snapshots point.
+    Returns:
+        Lockstep session, as player 0.
+    Raises:
+        OSError: The port could not be listened on.
+        ValueError: There are more images than snapshots can index.
+    """
+    if len(images) > IMAGE_MAX:
+        raise ValueError('too many images to show spectators: %d, at most '
+                         '%d' % (len(images), IMAGE_MAX))
+    session = Lockstep(None, 0, seed)
+    session._listener = socket.create_server(('', port))
+    session._listener.setblocking(False)
+    session._welcome = {'version': VERSION, 'role': 'spectator',
+                        'images': images}
+    print('Waiting for player 2 on port %d...' % port)
+    while session._peer is None:
+        accepted = session.poll(HELLO_TIMEOUT)
+        if accepted is None:
+            continue
+        connection, hello = accepted
+        welcome = {'version': VERSION, 'role': 'player', 'seed': seed,
+                   'rules': rules}
+        try:
+            connection.send_json(MSG_WELCOME, welcome)
+        except NetError:
+            connection.close()
+            continue
+        if hello.get('rules') != rules:
+            # The other side sees the difference too, and gives up
+            print('A player with other options tried to join')
+            connection.close()
+            continue
+        session._peer = connection
+    return session
+
+
+def join(address, rules):
+    """Join a game as the second player.
+    Args:
+        address: Tuple: (host, port).
+        rules: Dictionary of the options that change the game.
+    Returns:
+        Lockstep session, as player 1, with the seed of the host.
+    Raises:
+        NetError: The host could not be reached, or plays with other
+            options.
+    """
+    connection, welcome = _connect(address, {'role': 'player',
+                                             'rules': rules})
+    if welcome.get('role') != 'player':
+        connection.close()
+        raise NetError('the host did not let us play')
+    if welcome.get('rules') != rules:
+        connection.close()
+        differ = sorted(name for name in set(rules) | set(welcome['rules'])
+                        if rules.get(name) != welcome['rules'].get(name))
+        raise NetError('the host plays with other options: %s'
+                       % ', '.join(differ))
+    return Lockstep(connection, 1, welcome['seed'])
+
+
+class Spectator(object):
+    """Watches a game hosted elsewhere.
+    """
+    def __init__(self, address):
+        """Connect to the host.
+        Args:
+            address: Tuple: (host, port).
+        Raises:
+            NetError: The host could not be reached.
+        """
+        self._connection, welcome = _connect(address, {'role': 'spectator'})
+        self.images = welcome.get('images', [])
+        self.decoder = SnapshotDecoder()
+
+    def receive(self, timeout=None):
+        """Apply the next snapshot, if one comes in time.
+        Args:
+            timeout: Seconds to wait; None to wait for as long as it
+                takes.
+        Returns:
+            True if a snapshot was applied.
+        Raises:
+            NetError: The connection is lost, as when the game ends.
+        """
+        sock = self._connection.sock
+        if timeout is not None and not select.select([sock], [], [],
+                                                     timeout)[0]:
+            return False
+        self.decoder.decode(self._connection.receive(MSG_SNAPSHOT))
+        return True
+
+    def close(self):
+        """Close the connection.
+        """
+        self._connection.close()
@@ -0,0 +1,117 @@
+"""Recording and replaying of keyboard input, for reproducible games.
+
+A recording holds the random seed of the game and, for every simulation
+step that had any, the input events the game consumed in that step.
+Steps without input take no space.
+
+File layout (little-endian):
+    header: magic (4 bytes), version (1 byte), seed (8 bytes)
+    records: step (4 bytes), event count (1 byte), then per event:
+        type (1 byte), key (4 bytes)
+The last record has no events and marks the length of the recording.
+"""
+import struct
+
+import pygame
+
+
+MAGIC = b'JTRP'
+VERSION = 1
+HEADER = struct.Struct('<4sBq')
+RECORD = struct.Struct('<IB')
+EVENT = struct.Struct('<BI')
+EVENT_MAX = 255  # Events per record
+
+# Only these event types change the games; their codes in the file
+EVENT_TYPES = (pygame.QUIT, pygame.KEYDOWN, pygame.KEYUP)
+
+
+class InputRecorder(object):
+    """Writes the input events of every step to a file.
+    """
+    def __init__(self, path, seed):
+        """Start a recording.
+        Args:
+            path: File to record to.
+            seed: Random seed the game was started with.
+        """
+        self.step = 0
+        self._file = open(path, 'wb')
+        self._file.write(HEADER.pack(MAGIC, VERSION, seed))
+
+    def record(self, events):
+        """Record the events of one step.
+        Args:
+            events: Events the game consumed in this step.
+        """
+        events = [event for event in events if event.type in EVENT_TYPES]
+        while events:
+            chunk, events = events[:EVENT_MAX], events[EVENT_MAX:]
+            self._file.write(RECORD.pack(self.step, len(chunk)))
+            for event in chunk:
+                self._file.write(EVENT.pack(EVENT_TYPES.index(event.type),
+                                            getattr(event, 'key', 0)))
+        self.step += 1
+
+    def close(self):
+        """Finish the recording.
+        """
+        if not self._file.closed:
+            self._file.write(RECORD.pack(self.step, 0))
+            self._file.close()
+
+
+class InputReplayer(object):
+    """Feeds the input events of a recording back, step by step.
+    """
+    def __init__(self, path):
+        """Load a recording.
+        Args:
+            path: File to replay.
+        Raises:
+            ValueError: The file is not a recording, or is truncated or
+                corrupt.
+        """
+        with open(path, 'rb') as replay_file:
+            data = replay_file.read()
+        if len(data) < HEADER.size:
+            raise ValueError('%s is not an input recording' % path)
+        magic, version, self.seed = HEADER.unpack_from(data)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError('%s is not an input recording' % path)
+        self.step = 0
+        self.length = 0
+        self._steps = {}
+        offset = HEADER.size
+        while offset < len(data):
+            if offset + RECORD.size > len(data):
+                raise ValueError('%s is not a valid input recording' % path)
+            step, count = RECORD.unpack_from(data, offset)
+            offset += RECORD.size
+            if offset + count * EVENT.size > len(data):
+                raise ValueError('%s is not a valid input recording' % path)
+            events = self._steps.setdefault(step, [])
+            for _ in range(count):
+                type_code, key = EVENT.unpack_from(data, offset)
+                offset += EVENT.size
+                if type_code >= len(EVENT_TYPES):
+                    raise ValueError('%s is not a valid input recording'
+                                     % path)
+                events.append(pygame.event.Event(EVENT_TYPES[type_code],
+                                                 key=key))
+            self.length = max(self.length, step)
+
+    @property
+    def finished(self):
+        """True once every recorded step has been replayed.
+        """
+        return self.step >= self.length
+
+    def events(self):
+        """Get the events of the next step.
+        Returns:
+            List of events.
+        """
+        events = self._steps.get(self.step, [])
+        self.step += 1
+        return events
@@ -0,0 +1,52 @@
+"""Tests for loading input recordings."""
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pygame  # noqa: E402
+
+import replay  # noqa: E402
+
+
+class InputReplayerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'input.rec')
+        recorder = replay.InputRecorder(self.path, 1234)
+        recorder.record([pygame.event.Event(pygame.KEYDOWN, key=pygame.K_a)])
+        recorder.record([])
+        recorder.record([pygame.event.Event(pygame.KEYUP, key=pygame.K_a)])
+        recorder.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_load(self):
+        replayer = replay.InputReplayer(self.path)
+        self.assertEqual(replayer.seed, 1234)
+        self.assertEqual(replayer.length, 3)
+
+    def test_truncated(self):
+        size = os.path.getsize(self.path)
+        record_end = replay.HEADER.size + replay.RECORD.size
+        for length in (replay.HEADER.size + 1, record_end + 1, size - 1):
+            with open(self.path, 'r+b') as replay_file:
+                replay_file.truncate(length)
+            with self.assertRaisesRegex(ValueError, 'not a valid'):
+                replay.InputReplayer(self.path)
+
+    def test_bad_event_type(self):
+        with open(self.path, 'r+b') as replay_file:
+            replay_file.seek(replay.HEADER.size + replay.RECORD.size)
+            replay_file.write(bytes([len(replay.EVENT_TYPES)]))
+        with self.assertRaisesRegex(ValueError, 'not a valid'):
+            replay.InputReplayer(self.path)
+
+
+if __name__ == '__main__':
+    unittest.main()